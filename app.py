@@ -1,271 +1,2017 @@
-import re                                                                                                                                                                               │
-import logging                                                                                                                                                                          │
-from datetime import datetime                                                                                                                                                           │
-from typing import Optional, Dict, List, Tuple                                                                                                                                          │
-                                                                                                                                                                                        │
-import sqlalchemy as db                                                                                                                                                                 │
-from sqlalchemy import Column, Integer, String, Float, ForeignKey, DateTime                                                                                                             │
-from sqlalchemy.orm import relationship, Session                                                                                                                                        │
-from sqlalchemy.ext.declarative import declarative_base                                                                                                                                 │
-                                                                                                                                                                                        │
-from flask import Flask, request, jsonify                                                                                                                                               │
-from flask_jwt_extended import JWTManager, jwt_required, create_access_token                                                                                                            │
-                                                                                                                                                                                        │
-# Set up logging                                                                                                                                                                        │
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')                                                                                             │
-                                                                                                                                                                                        │
-# Database setup                                                                                                                                                                        │
-engine = db.create_engine('sqlite:///receipts.db')                                                                                                                                      │
-Base = declarative_base()                                                                                                                                                               │
-                                                                                                                                                                                        │
-# Define database models                                                                                                                                                                │
-class User(Base):                                                                                                                                                                       │
-    __tablename__ = 'users'                                                                                                                                                             │
-                                                                                                                                                                                        │
-    id = Column(Integer, primary_key=True)                                                                                                                                              │
-    username = Column(String, nullable=False, unique=True)                                                                                                                              │
-    password = Column(String, nullable=False)                                                                                                                                           │
-                                                                                                                                                                                        │
-    receipts = relationship('Receipt', back_populates='user')                                                                                                                           │
-                                                                                                                                                                                        │
-class Receipt(Base):                                                                                                                                                                    │
-    __tablename__ = 'receipts'                                                                                                                                                          │
-                                                                                                                                                                                        │
-    id = Column(Integer, primary_key=True)                                                                                                                                              │
-    user_id = Column(Integer, ForeignKey('users.id'), nullable=False)                                                                                                                   │
-    merchant = Column(String, nullable=False)                                                                                                                                           │
-    date = Column(DateTime, nullable=False)                                                                                                                                             │
-    total = Column(Float, nullable=False)                                                                                                                                               │
-                                                                                                                                                                                        │
-    user = relationship('User', back_populates='receipts')                                                                                                                              │
-    items = relationship('Item', back_populates='receipt')                                                                                                                              │
-                                                                                                                                                                                        │
-class Item(Base):                                                                                                                                                                       │
-    __tablename__ = 'items'                                                                                                                                                             │
-                                                                                                                                                                                        │
-    id = Column(Integer, primary_key=True)                                                                                                                                              │
-    receipt_id = Column(Integer, ForeignKey('receipts.id'), nullable=False)                                                                                                             │
-    name = Column(String, nullable=False)                                                                                                                                               │
-    quantity = Column(String, nullable=True)                                                                                                                                            │
-    price = Column(Float, nullable=False)                                                                                                                                               │
-                                                                                                                                                                                        │
-    receipt = relationship('Receipt', back_populates='items')                                                                                                                           │
-                                                                                                                                                                                        │
-Base.metadata.create_all(engine)                                                                                                                                                        │
-                                                                                                                                                                                        │
-# Data validation and normalization                                                                                                                                                     │
-def validate_receipt_data(data: Dict) -> Optional[Dict]:                                                                                                                                │
-    errors = []                                                                                                                                                                         │
-                                                                                                                                                                                        │
-    # Validate merchant                                                                                                                                                                 │
-    merchant = data.get('merchant')                                                                                                                                                     │
-    if not merchant or not isinstance(merchant, str):                                                                                                                                   │
-        errors.append('Invalid merchant name')                                                                                                                                          │
-    else:                                                                                                                                                                               │
-        data['merchant'] = merchant.strip().title()                                                                                                                                     │
-                                                                                                                                                                                        │
-    # Validate date                                                                                                                                                                     │
-    date_str = data.get('date')                                                                                                                                                         │
-    if not date_str or not isinstance(date_str, str):                                                                                                                                   │
-        errors.append('Invalid date format')                                                                                                                                            │
-    else:                                                                                                                                                                               │
-        try:                                                                                                                                                                            │
-            data['date'] = datetime.strptime(date_str, '%Y-%m-%d').date()                                                                                                               │
-        except ValueError:                                                                                                                                                              │
-            errors.append('Invalid date format')                                                                                                                                        │
-                                                                                                                                                                                        │
-    # Validate total                                                                                                                                                                    │
-    total = data.get('total')                                                                                                                                                           │
-    if not total or not isinstance(total, (int, float)):                                                                                                                                │
-        errors.append('Invalid total amount')                                                                                                                                           │
-                                                                                                                                                                                        │
-    # Validate items                                                                                                                                                                    │
-    items = data.get('items', [])                                                                                                                                                       │
-    for item in items:                                                                                                                                                                  │
-        name = item.get('name')                                                                                                                                                         │
-        if not name or not isinstance(name, str):                                                                                                                                       │
-            errors.append('Invalid item name')                                                                                                                                          │
-        else:                                                                                                                                                                           │
-            item['name'] = name.strip()                                                                                                                                                 │
-                                                                                                                                                                                        │
-        quantity = item.get('quantity')                                                                                                                                                 │
-        if quantity and not isinstance(quantity, str):                                                                                                                                  │
-            errors.append('Invalid item quantity')                                                                                                                                      │
-        else:                                                                                                                                                                           │
-            item['quantity'] = quantity.strip() if quantity else None                                                                                                                   │
-                                                                                                                                                                                        │
-        price = item.get('price')                                                                                                                                                       │
-        if not price or not isinstance(price, (int, float)):                                                                                                                            │
-            errors.append('Invalid item price')                                                                                                                                         │
-                                                                                                                                                                                        │
-    if errors:                                                                                                                                                                          │
-        logging.error(f'Validation errors: {errors}')                                                                                                                                   │
-        return None                                                                                                                                                                     │
-                                                                                                                                                                                        │
-    return data                                                                                                                                                                         │
-                                                                                                                                                                                        │
-# Database operations                                                                                                                                                                   │
-def save_receipt_data(data: Dict, user_id: int) -> Optional[Receipt]:                                                                                                                   │
-    session = Session(bind=engine)                                                                                                                                                      │
-                                                                                                                                                                                        │
-    try:                                                                                                                                                                                │
-        merchant = data['merchant']                                                                                                                                                     │
-        date = data['date']                                                                                                                                                             │
-        total = data['total']                                                                                                                                                           │
-        items = data.get('items', [])                                                                                                                                                   │
-                                                                                                                                                                                        │
-        receipt = Receipt(user_id=user_id, merchant=merchant, date=date, total=total)                                                                                                   │
-        session.add(receipt)                                                                                                                                                            │
-        session.flush()  # Get the receipt ID                                                                                                                                           │
-                                                                                                                                                                                        │
-        for item in items:                                                                                                                                                              │
-            name = item['name']                                                                                                                                                         │
-            quantity = item.get('quantity')                                                                                                                                             │
-            price = item['price']                                                                                                                                                       │
-            item_obj = Item(receipt_id=receipt.id, name=name, quantity=quantity, price=price)                                                                                           │
-            session.add(item_obj)                                                                                                                                                       │
-                                                                                                                                                                                        │
-        session.commit()                                                                                                                                                                │
-        return receipt                                                                                                                                                                  │
-    except Exception as e:                                                                                                                                                              │
-        logging.error(f'Error saving receipt data: {e}')                                                                                                                                │
-        session.rollback()                                                                                                                                                              │
-    finally:                                                                                                                                                                            │
-        session.close()                                                                                                                                                                 │
-                                                                                                                                                                                        │
-    return None                                                                                                                                                                         │
-                                                                                                                                                                                        │
-# API setup                                                                                                                                                                             │
-app = Flask(__name__)                                                                                                                                                                   │
-app.config['JWT_SECRET_KEY'] = 'your-secret-key'                                                                                                                                        │
-jwt = JWTManager(app)                                                                                                                                                                   │
-                                                                                                                                                                                        │
-@app.route('/register', methods=['POST'])                                                                                                                                               │
-def register():                                                                                                                                                                         │
-    data = request.get_json()                                                                                                                                                           │
-    username = data.get('username')                                                                                                                                                     │
-    password = data.get('password')                                                                                                                                                     │
-                                                                                                                                                                                        │
-    if not username or not password:                                                                                                                                                    │
-        return jsonify({'error': 'Username and password are required'}), 400                                                                                                            │
-                                                                                                                                                                                        │
-    session = Session(bind=engine)                                                                                                                                                      │
-    try:                                                                                                                                                                                │
-        existing_user = session.query(User).filter_by(username=username).first()                                                                                                        │
-        if existing_user:                                                                                                                                                               │
-            return jsonify({'error': 'Username already exists'}), 400                                                                                                                   │
-                                                                                                                                                                                        │
-        user = User(username=username, password=password)                                                                                                                               │
-        session.add(user)                                                                                                                                                               │
-        session.commit()                                                                                                                                                                │
-        return jsonify({'message': 'User registered successfully'}), 201                                                                                                                │
-    except Exception as e:                                                                                                                                                              │
-        logging.error(f'Error registering user: {e}')                                                                                                                                   │
-        session.rollback()                                                                                                                                                              │
-        return jsonify({'error': 'Internal server error'}), 500                                                                                                                         │
-    finally:                                                                                                                                                                            │
-        session.close()                                                                                                                                                                 │
-                                                                                                                                                                                        │
-@app.route('/login', methods=['POST'])                                                                                                                                                  │
-def login():                                                                                                                                                                            │
-    data = request.get_json()                                                                                                                                                           │
-    username = data.get('username')                                                                                                                                                     │
-    password = data.get('password')                                                                                                                                                     │
-                                                                                                                                                                                        │
-    if not username or not password:                                                                                                                                                    │
-        return jsonify({'error': 'Username and password are required'}), 400                                                                                                            │
-                                                                                                                                                                                        │
-    session = Session(bind=engine)                                                                                                                                                      │
-    try:                                                                                                                                                                                │
-        user = session.query(User).filter_by(username=username, password=password).first()                                                                                              │
-        if not user:                                                                                                                                                                    │
-            return jsonify({'error': 'Invalid username or password'}), 401                                                                                                              │
-                                                                                                                                                                                        │
-        access_token = create_access_token(identity=user.id)                                                                                                                            │
-        return jsonify({'access_token': access_token}), 200                                                                                                                             │
-    except Exception as e:                                                                                                                                                              │
-        logging.error(f'Error logging in user: {e}')                                                                                                                                    │
-        return jsonify({'error': 'Internal server error'}), 500                                                                                                                         │
-    finally:                                                                                                                                                                            │
-        session.close()                                                                                                                                                                 │
-                                                                                                                                                                                        │
-@app.route('/receipts', methods=['POST'])                                                                                                                                               │
-@jwt_required()                                                                                                                                                                         │
-def upload_receipt():                                                                                                                                                                   │
-    user_id = get_jwt_identity()                                                                                                                                                        │
-    data = request.get_json()                                                                                                                                                           │
-                                                                                                                                                                                        │
-    validated_data = validate_receipt_data(data)                                                                                                                                        │
-    if not validated_data:                                                                                                                                                              │
-        return jsonify({'error': 'Invalid receipt data'}), 400                                                                                                                          │
-                                                                                                                                                                                        │
-    receipt = save_receipt_data(validated_data, user_id)                                                                                                                                │
-    if not receipt:                                                                                                                                                                     │
-        return jsonify({'error': 'Failed to save receipt data'}), 500                                                                                                                   │
-                                                                                                                                                                                        │
-    return jsonify({'message': 'Receipt uploaded successfully', 'receipt_id': receipt.id}), 201                                                                                         │
-                                                                                                                                                                                        │
-@app.route('/receipts/<int:receipt_id>', methods=['GET'])                                                                                                                               │
-@jwt_required()                                                                                                                                                                         │
-def get_receipt(receipt_id):                                                                                                                                                            │
-    user_id = get_jwt_identity()                                                                                                                                                        │
-    session = Session(bind=engine)                                                                                                                                                      │
-                                                                                                                                                                                        │
-    try:                                                                                                                                                                                │
-        receipt = session.query(Receipt).filter_by(id=receipt_id, user_id=user_id).first()                                                                                              │
-        if not receipt:                                                                                                                                                                 │
-            return jsonify({'error': 'Receipt not found'}), 404                                                                                                                         │
-                                                                                                                                                                                        │
-        receipt_data = {                                                                                                                                                                │
-            'merchant': receipt.merchant,                                                                                                                                               │
-            'date': receipt.date.isoformat(),                                                                                                                                           │
-            'total': float(receipt.total),                                                                                                                                              │
-            'items': [                                                                                                                                                                  │
-                {                                                                                                                                                                       │
-                    'name': item.name,                                                                                                                                                  │
-                    'quantity': item.quantity,                                                                                                                                          │
-                    'price': float(item.price)                                                                                                                                          │
-                }                                                                                                                                                                       │
-                for item in receipt.items                                                                                                                                               │
-            ]                                                                                                                                                                           │
-        }                                                                                                                                                                               │
-        return jsonify(receipt_data), 200                                                                                                                                               │
-    except Exception as e:                                                                                                                                                              │
-        logging.error(f'Error retrieving receipt data: {e}')                                                                                                                            │
-        return jsonify({'error': 'Internal server error'}), 500                                                                                                                         │
-    finally:                                                                                                                                                                            │
-        session.close()                                                                                                                                                                 │
-                                                                                                                                                                                        │
-# Helper function to get JWT identity                                                                                                                                                   │
-def get_jwt_identity():                                                                                                                                                                 │
-    return jwt.get_jwt_identity()                                                                                                                                                       │
-                                                                                                                                                                                        │
+import io
+import re
+import csv
+import json
+import time
+import zlib
+import uuid
+import queue
+import atexit
+import bisect
+import base64
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import date, datetime
+from functools import wraps
+from typing import Any, Optional, Dict, List, Tuple, Iterable, Iterator, NamedTuple, Hashable
+
+import click
+import sqlalchemy as db
+from sqlalchemy import Column, Integer, String, Float, ForeignKey, DateTime, Date, Index, func, event
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import relationship, selectinload, scoped_session, sessionmaker, Session
+from sqlalchemy.ext.associationproxy import association_proxy
+from sqlalchemy.ext.declarative import declarative_base
+
+from flask import Flask, Response, g, has_request_context, request, jsonify, stream_with_context
+from flask_jwt_extended import JWTManager, jwt_required, create_access_token
+from flask_jwt_extended import get_jwt_identity as current_identity
+
+try:
+    import pyarrow as pa
+except ImportError:  # optional, only needed for Arrow exports
+    pa = None
+
+# Set up logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Database setup
+Base = declarative_base()
+
+# Bound by configure_database(). engine and db_session hold users and the
+# shard directory; router hands out sessions for each user's receipts shard.
+# Handlers get one session per request.
+engine = None
+router = None
+db_session = scoped_session(sessionmaker(expire_on_commit=False))
+
+DEFAULT_CATEGORY = 'Uncategorized'
+
+# Define database models
+class User(Base):
+    __tablename__ = 'users'
+
+    id = Column(Integer, primary_key=True)
+    username = Column(String, nullable=False, unique=True)
+    password = Column(String, nullable=False)
+
+    receipts = relationship('Receipt', back_populates='user')
+
+class UserShard(Base):
+    """Directory entry recording which shard holds a user's receipts."""
+    __tablename__ = 'user_shards'
+
+    user_id = Column(Integer, ForeignKey('users.id'), primary_key=True)
+    shard = Column(Integer, nullable=False)
+    # Shard that may still hold rows from an unfinished move_user()
+    stale_shard = Column(Integer)
+    # Set once a move has repointed the user: the last receipt id copied
+    # from the source, which is now stale_shard
+    copied_through = Column(Integer)
+
+class Merchant(Base):
+    """Interned merchant name, referenced by id from receipts."""
+    __tablename__ = 'merchants'
+
+    id = Column(Integer, primary_key=True)
+    name = Column(String, nullable=False, unique=True)
+
+class ItemName(Base):
+    """Interned item name, referenced by id from items."""
+    __tablename__ = 'item_names'
+
+    id = Column(Integer, primary_key=True)
+    name = Column(String, nullable=False, unique=True)
+
+class Receipt(Base):
+    __tablename__ = 'receipts'
+
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
+    merchant_id = Column(Integer, ForeignKey('merchants.id'), nullable=False)
+    date = Column(DateTime, nullable=False)
+    total = Column(Float, nullable=False)
+    category = Column(String, nullable=False, default=DEFAULT_CATEGORY, server_default=DEFAULT_CATEGORY)
+
+    user = relationship('User', back_populates='receipts')
+    items = relationship('Item', back_populates='receipt')
+    merchant_ref = relationship('Merchant', lazy='joined')
+    merchant = association_proxy('merchant_ref', 'name')
+
+    __table_args__ = (
+        Index('ix_receipts_user_id_date', 'user_id', 'date'),
+    )
+
+    def serialize(self, include_items: bool = False) -> Dict:
+        data = {
+            'id': self.id,
+            'merchant': self.merchant,
+            'date': self.date.isoformat(),
+            'total': float(self.total),
+            'category': self.category,
+        }
+        if include_items:
+            data['items'] = [item.serialize() for item in self.items]
+        return data
+
+class Item(Base):
+    __tablename__ = 'items'
+
+    id = Column(Integer, primary_key=True)
+    receipt_id = Column(Integer, ForeignKey('receipts.id'), nullable=False, index=True)
+    name_id = Column(Integer, ForeignKey('item_names.id'), nullable=False, index=True)
+    quantity = Column(String, nullable=True)
+    price = Column(Float, nullable=False)
+
+    receipt = relationship('Receipt', back_populates='items')
+    item_name = relationship('ItemName', lazy='joined')
+    name = association_proxy('item_name', 'name')
+
+    def serialize(self) -> Dict:
+        return {
+            'name': self.name,
+            'quantity': self.quantity,
+            'price': float(self.price)
+        }
+
+class ExpenseRollup(Base):
+    """Running per-user, per-day, per-category totals of receipts."""
+    __tablename__ = 'expense_rollups'
+
+    user_id = Column(Integer, ForeignKey('users.id'), primary_key=True)
+    day = Column(Date, primary_key=True)
+    category = Column(String, primary_key=True)
+    total = Column(Float, nullable=False, default=0.0)
+    receipt_count = Column(Integer, nullable=False, default=0)
+
+def rebuild_expense_rollups(session: Session) -> None:
+    """Recompute the whole rollup table from the receipts table."""
+    session.query(ExpenseRollup).delete()
+    session.execute(ExpenseRollup.__table__.insert().from_select(
+        ['user_id', 'day', 'category', 'total', 'receipt_count'],
+        db.select(
+            Receipt.user_id,
+            func.date(Receipt.date),
+            Receipt.category,
+            func.sum(Receipt.total),
+            func.count(Receipt.id),
+        ).group_by(Receipt.user_id, func.date(Receipt.date), Receipt.category)
+    ))
+
+def search_document(user_id: int, merchant: str, item_names: Iterable[str]) -> Dict:
+    # The owner token lets FTS5 intersect a user's documents itself instead
+    # of matching every user's receipts and filtering afterwards.
+    return {'owner': f'u{user_id}', 'merchant': merchant, 'items': ' '.join(item_names)}
+
+def create_search_index(conn) -> bool:
+    """Create the FTS5 receipt search table; False if SQLite lacks FTS5."""
+    try:
+        conn.execute(db.text(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS receipt_search "
+            "USING fts5(owner, merchant, items, tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')"
+        ))
+    except db.exc.OperationalError as e:
+        logging.warning(f'Full-text search disabled: {e}')
+        return False
+    return True
+
+def rebuild_search_index(session: Session) -> None:
+    """Re-index every receipt's merchant and item names."""
+    session.execute(db.text('DELETE FROM receipt_search'))
+    session.execute(db.text(
+        "INSERT INTO receipt_search (rowid, owner, merchant, items) "
+        "SELECT receipts.id, 'u' || receipts.user_id, merchants.name, COALESCE(group_concat(item_names.name, ' '), '') "
+        "FROM receipts JOIN merchants ON merchants.id = receipts.merchant_id "
+        "LEFT JOIN items ON items.receipt_id = receipts.id "
+        "LEFT JOIN item_names ON item_names.id = items.name_id "
+        "GROUP BY receipts.id"
+    ))
+
+def intern_legacy_column(conn, table: str, column: str, id_column: str, dictionary: str) -> None:
+    """Replace a free-text column with ids into a dictionary table."""
+    conn.execute(db.text(f'ALTER TABLE {table} ADD COLUMN {id_column} INTEGER REFERENCES {dictionary}(id)'))
+    conn.execute(db.text(f'INSERT OR IGNORE INTO {dictionary} (name) SELECT DISTINCT {column} FROM {table}'))
+    conn.execute(db.text(
+        f'UPDATE {table} SET {id_column} = (SELECT id FROM {dictionary} WHERE {dictionary}.name = {table}.{column})'
+    ))
+    conn.execute(db.text(f'ALTER TABLE {table} DROP COLUMN {column}'))
+    logging.info(f'Interned {table}.{column} into {dictionary}')
+
+@contextmanager
+def migration_transaction(target_engine: db.engine.Engine) -> Iterator[db.engine.Connection]:
+    """Yield a connection holding the database's write lock until commit."""
+    with target_engine.connect() as conn:
+        if conn.dialect.name == 'sqlite':
+            # Every worker migrates on startup. Taking the write lock before
+            # inspecting makes them queue up, and each later one finds the
+            # schema already migrated instead of repeating the work.
+            conn.exec_driver_sql('BEGIN IMMEDIATE')
+        yield conn
+        conn.commit()
+
+# Tables holding receipt data, present on every shard. Users and the shard
+# directory live only in the main database.
+SHARD_TABLES = [Merchant.__table__, ItemName.__table__, Receipt.__table__, Item.__table__, ExpenseRollup.__table__]
+
+def migrate_schema(target_engine: db.engine.Engine, directory: bool = True) -> bool:
+    """Bring an existing database up to date with the models.
+
+    With directory=False only SHARD_TABLES and the search index are managed.
+    Runs in a single transaction, so concurrent callers wait for each other
+    (up to DATABASE_TIMEOUT) and a failed migration leaves nothing behind.
+    Returns whether full-text search is available on the database.
+    """
+    with migration_transaction(target_engine) as conn:
+        inspector = db.inspect(conn)
+        had_rollups = inspector.has_table('expense_rollups')
+        had_search = inspector.has_table('receipt_search')
+        had_directory = inspector.has_table('user_shards')
+        tables = Base.metadata.sorted_tables if directory else SHARD_TABLES
+
+        if inspector.has_table('receipts'):
+            columns = {column['name'] for column in inspector.get_columns('receipts')}
+            if 'category' not in columns:
+                conn.execute(db.text(
+                    f"ALTER TABLE receipts ADD COLUMN category VARCHAR NOT NULL DEFAULT '{DEFAULT_CATEGORY}'"
+                ))
+
+        if directory and had_directory:
+            columns = {column['name'] for column in inspector.get_columns('user_shards')}
+            for column in ('stale_shard', 'copied_through'):
+                if column not in columns:
+                    conn.execute(db.text(f'ALTER TABLE user_shards ADD COLUMN {column} INTEGER'))
+
+        Base.metadata.create_all(conn, tables=tables)
+
+        legacy_columns = [
+            ('receipts', 'merchant', 'merchant_id', 'merchants'),
+            ('items', 'name', 'name_id', 'item_names'),
+        ]
+        for table, column, id_column, dictionary in legacy_columns:
+            columns = {info['name'] for info in db.inspect(conn).get_columns(table)}
+            if column in columns and id_column not in columns:
+                intern_legacy_column(conn, table, column, id_column, dictionary)
+
+        # create_all skips indexes on tables that already exist
+        for table in tables:
+            for index in table.indexes:
+                index.create(conn, checkfirst=True)
+
+        search_enabled = create_search_index(conn)
+
+        # Joins the migration transaction; committed with it
+        session = Session(bind=conn)
+        if not had_rollups:
+            rebuild_expense_rollups(session)
+        if search_enabled and not had_search:
+            rebuild_search_index(session)
+        if directory and not had_directory:
+            # Users from before sharding keep their receipts in this
+            # database, which is always shard 0
+            session.execute(UserShard.__table__.insert().from_select(
+                ['user_id', 'shard'], db.select(User.id, db.literal(0))
+            ))
+        session.close()
+
+    return search_enabled
+
+def set_sqlite_pragmas(dbapi_connection, connection_record) -> None:
+    cursor = dbapi_connection.cursor()
+    try:
+        for name, value in app.config['SQLITE_PRAGMAS'].items():
+            cursor.execute(f'PRAGMA {name} = {value}')
+    finally:
+        cursor.close()
+
+def create_db_engine(url: str) -> db.engine.Engine:
+    """Create an engine for url using the pool settings in app.config."""
+    url = db.engine.make_url(url)
+    options = {}
+
+    if url.get_backend_name() == 'sqlite':
+        options['connect_args'] = {'check_same_thread': False, 'timeout': app.config['DATABASE_TIMEOUT']}
+    else:
+        # A local SQLite file can't drop the connection; servers can
+        options['pool_pre_ping'] = True
+    if url.database not in (None, '', ':memory:'):
+        options.update(
+            pool_size=app.config['DATABASE_POOL_SIZE'],
+            max_overflow=app.config['DATABASE_MAX_OVERFLOW'],
+            pool_timeout=app.config['DATABASE_TIMEOUT'],
+        )
+
+    new_engine = db.create_engine(url, **options)
+    if url.get_backend_name() == 'sqlite':
+        event.listen(new_engine, 'connect', set_sqlite_pragmas)
+    instrument_engine(new_engine)
+    return new_engine
+
+def configure_database(url: Optional[str] = None, shard_urls: Optional[List[str]] = None) -> None:
+    """Point the app at a database, creating or migrating its schema.
+
+    Defaults to app.config['DATABASE_URL'] and app.config['SHARD_URLS']; pass
+    urls to switch databases, e.g. to temporary files in tests or benchmarks.
+    The main database is always shard 0 and the shard urls add shards 1..N.
+    """
+    global engine, router
+
+    if url:
+        app.config['DATABASE_URL'] = url
+    if shard_urls is not None:
+        app.config['SHARD_URLS'] = shard_urls
+
+    if router is not None:
+        router.dispose()
+    db_session.remove()
+    if engine is not None:
+        engine.dispose()
+
+    engine = create_db_engine(app.config['DATABASE_URL'])
+    db_session.configure(bind=engine)
+    # Shard 0 migrates the main database
+    router = ShardRouter(engine, app.config['SHARD_URLS'], app.config['SHARD_DIRECTORY_TTL'])
+
+# Data validation and normalization
+def parse_date(value: str) -> date:
+    """Parse a YYYY-MM-DD date, taking the C fast path for canonical input."""
+    # fromisoformat also accepts other 10-character forms such as 2024-W01-1
+    if len(value) == 10 and value[4] == value[7] == '-':
+        try:
+            return date.fromisoformat(value)
+        except ValueError:
+            pass
+    return datetime.strptime(value, '%Y-%m-%d').date()
+
+AMOUNT_TYPES = frozenset((int, float))
+
+class ReceiptValidator:
+    """Validate and normalize receipt payloads without mutating them.
+
+    Errors are reported per field, keyed by paths such as 'date' or
+    'items[2].price'. Normalized merchant names and parsed dates are memoized
+    since the same values recur across a batch.
+    """
+
+    def __init__(self, name_cache_size: int = 10000):
+        self.name_cache_size = name_cache_size
+        self._merchant_names = {}
+        self._dates = {}
+
+    def validate(self, data):
+        """Validate one receipt, or a list of receipts.
+
+        For a single receipt returns (receipt, errors). For a list returns the
+        same as validate_many() over the list's indexes.
+        """
+        if isinstance(data, list):
+            return self.validate_many(enumerate(data))
+        return self._validate(data)
+
+    def validate_many(self, records: Iterable[Tuple[int, Any]]) -> Tuple[List[Tuple[int, Dict]], List[Dict]]:
+        """Validate (index, receipt) pairs.
+
+        Returns the valid (index, receipt) pairs and one
+        {'index': ..., 'errors': {...}} dict per invalid record.
+        """
+        valid = []
+        invalid = []
+        validate = self._validate
+        for index, data in records:
+            receipt, errors = validate(data)
+            if errors:
+                invalid.append({'index': index, 'errors': errors})
+            else:
+                valid.append((index, receipt))
+        return valid, invalid
+
+    def _normalize_merchant(self, merchant: str) -> str:
+        normalized = merchant.strip().title()
+        if len(self._merchant_names) >= self.name_cache_size:
+            self._merchant_names.clear()
+        self._merchant_names[merchant] = normalized
+        return normalized
+
+    def _parse_date(self, value) -> date:
+        parsed = parse_date(value)
+        if len(self._dates) >= self.name_cache_size:
+            self._dates.clear()
+        self._dates[value] = parsed
+        return parsed
+
+    def _validate(self, data) -> Tuple[Optional[Dict], Dict[str, str]]:
+        if type(data) is not dict:
+            return None, {'receipt': 'Expected a JSON object'}
+
+        errors = {}
+
+        # Validate merchant
+        merchant = data.get('merchant')
+        normalized = self._merchant_names.get(merchant) if type(merchant) is str else None
+        if normalized is None and merchant and type(merchant) is str:
+            normalized = self._normalize_merchant(merchant)
+        if not normalized:
+            errors['merchant'] = 'Invalid merchant name'
+
+        # Validate date
+        date_str = data.get('date')
+        receipt_date = self._dates.get(date_str) if type(date_str) is str else None
+        if receipt_date is None:
+            try:
+                receipt_date = self._parse_date(date_str)
+            except (TypeError, ValueError):
+                errors['date'] = 'Invalid date format'
+
+        # Validate category
+        category = data.get('category')
+        if category is None:
+            category = DEFAULT_CATEGORY
+        elif type(category) is str and category.strip():
+            category = category.strip().title()
+        else:
+            errors['category'] = 'Invalid category'
+
+        # Validate total
+        total = data.get('total')
+        if type(total) not in AMOUNT_TYPES or not total:
+            errors['total'] = 'Invalid total amount'
+
+        # Validate items
+        items = data.get('items')
+        if items is None:
+            items = []
+        elif type(items) is not list:
+            errors['items'] = 'Invalid items'
+            items = []
+
+        clean_items = []
+        for i, item in enumerate(items):
+            if type(item) is not dict:
+                errors[f'items[{i}]'] = 'Expected a JSON object'
+                continue
+
+            name = item.get('name')
+            if name and type(name) is str:
+                name = name.strip()
+            if not name or type(name) is not str:
+                errors[f'items[{i}].name'] = 'Invalid item name'
+
+            quantity = item.get('quantity')
+            if quantity and type(quantity) is not str:
+                errors[f'items[{i}].quantity'] = 'Invalid item quantity'
+            else:
+                quantity = (quantity.strip() or None) if quantity else None
+
+            price = item.get('price')
+            if type(price) not in AMOUNT_TYPES or not price:
+                errors[f'items[{i}].price'] = 'Invalid item price'
+
+            clean_items.append({'name': name, 'quantity': quantity, 'price': price})
+
+        if errors:
+            return None, errors
+
+        return {
+            'merchant': normalized,
+            'date': receipt_date,
+            'category': category,
+            'total': total,
+            'items': clean_items,
+        }, {}
+
+receipt_validator = ReceiptValidator()
+
+def validate_receipt_data(data: Dict) -> Optional[Dict]:
+    receipt, errors = receipt_validator.validate(data)
+    if errors:
+        logging.error(f'Validation errors: {errors}')
+        return None
+
+    return receipt
+
+# Database operations
+class NameDictionary:
+    """In-process cache of an interned name table.
+
+    Names missing from the cache are inserted in the caller's transaction;
+    their ids are only cached once that transaction commits, so a rollback
+    can never leave the cache pointing at rows that don't exist. The cache is
+    emptied once it holds cache_size names.
+    """
+
+    def __init__(self, model, cache_size: int = 100000):
+        self.table = model.__table__
+        self.cache_size = cache_size
+        self._ids = {}
+        self._names = {}
+        self._lock = threading.Lock()
+
+    def ids(self, session: Session, names: Iterable[str]) -> Dict[str, int]:
+        """Map names to ids, creating dictionary rows for new names."""
+        resolved = {}
+        missing = []
+        for name in set(names):
+            name_id = self._ids.get(name)
+            if name_id is None:
+                missing.append(name)
+            else:
+                resolved[name] = name_id
+
+        if missing:
+            session.execute(sqlite_insert(self.table).on_conflict_do_nothing(index_elements=['name']),
+                            [{'name': name} for name in missing])
+            rows = session.execute(
+                db.select(self.table.c.name, self.table.c.id).where(self.table.c.name.in_(missing))
+            ).all()
+            pending = dict(rows)
+            session.info.setdefault('pending_names', []).append((self, pending))
+            resolved.update(pending)
+
+        return resolved
+
+    def names(self, session: Session, ids: Iterable[int]) -> Dict[int, str]:
+        """Map ids back to names."""
+        resolved = {}
+        missing = []
+        for name_id in set(ids):
+            name = self._names.get(name_id)
+            if name is None:
+                missing.append(name_id)
+            else:
+                resolved[name_id] = name
+
+        if missing:
+            rows = session.execute(
+                db.select(self.table.c.name, self.table.c.id).where(self.table.c.id.in_(missing))
+            ).all()
+            found = dict(rows)
+            self._store(found)
+            resolved.update((name_id, name) for name, name_id in found.items())
+
+        return resolved
+
+    def clear(self) -> None:
+        with self._lock:
+            self._ids.clear()
+            self._names.clear()
+
+    def _store(self, ids: Dict[str, int]) -> None:
+        with self._lock:
+            if len(self._ids) + len(ids) > self.cache_size:
+                self._ids.clear()
+                self._names.clear()
+            self._ids.update(ids)
+            self._names.update((name_id, name) for name, name_id in ids.items())
+
+def commit_pending_names(session: Session) -> None:
+    for dictionary, ids in session.info.pop('pending_names', ()):
+        dictionary._store(ids)
+
+def discard_pending_names(session: Session) -> None:
+    session.info.pop('pending_names', None)
+
+event.listen(Session, 'after_commit', commit_pending_names)
+event.listen(Session, 'after_rollback', discard_pending_names)
+
+def insert_receipts(session: Session, user_id: int, records: List[Dict]) -> List[Receipt]:
+    """Insert validated receipts and their items without committing.
+
+    Receipts are flushed together so their ids come back in one round trip,
+    then all items are written with a single executemany. The session must
+    come from a shard, see ShardRouter.session().
+    """
+    shard = session.info['shard']
+    merchant_ids = shard.merchants.ids(session, (data['merchant'] for data in records))
+    name_ids = shard.item_names.ids(
+        session, (item['name'] for data in records for item in data.get('items', []))
+    )
+
+    receipts = [
+        Receipt(user_id=user_id, merchant_id=merchant_ids[data['merchant']], date=data['date'],
+                total=data['total'], category=data.get('category', DEFAULT_CATEGORY))
+        for data in records
+    ]
+    session.add_all(receipts)
+    session.flush()  # Get the receipt IDs
+
+    item_rows = [
+        {
+            'receipt_id': receipt.id,
+            'name_id': name_ids[item['name']],
+            'quantity': item.get('quantity'),
+            'price': item['price'],
+        }
+        for receipt, data in zip(receipts, records)
+        for item in data.get('items', [])
+    ]
+    if item_rows:
+        session.execute(Item.__table__.insert(), item_rows)
+
+    update_expense_rollups(session, user_id, records)
+    if shard.search_enabled:
+        session.execute(db.text(
+            'INSERT INTO receipt_search (rowid, owner, merchant, items) VALUES (:rowid, :owner, :merchant, :items)'
+        ), [
+            {'rowid': receipt.id,
+             **search_document(user_id, data['merchant'], (item['name'] for item in data.get('items', [])))}
+            for receipt, data in zip(receipts, records)
+        ])
+    return receipts
+
+def update_expense_rollups(session: Session, user_id: int, records: List[Dict], sign: int = 1) -> None:
+    """Add (or with sign=-1, subtract) receipts to the rollup table.
+
+    Must run in the same transaction as the receipt change so the rollup
+    never drifts from the receipts table.
+    """
+    deltas = {}
+    for data in records:
+        day = data['date']
+        if isinstance(day, datetime):
+            day = day.date()
+        key = (day, data.get('category', DEFAULT_CATEGORY))
+        total, count = deltas.get(key, (0.0, 0))
+        deltas[key] = (total + sign * data['total'], count + sign)
+
+    if not deltas:
+        return
+
+    stmt = sqlite_insert(ExpenseRollup.__table__)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['user_id', 'day', 'category'],
+        set_={
+            'total': ExpenseRollup.__table__.c.total + stmt.excluded.total,
+            'receipt_count': ExpenseRollup.__table__.c.receipt_count + stmt.excluded.receipt_count,
+        }
+    )
+    session.execute(stmt, [
+        {'user_id': user_id, 'day': day, 'category': category, 'total': total, 'receipt_count': count}
+        for (day, category), (total, count) in deltas.items()
+    ])
+
+def save_receipt_data(data: Dict, user_id: int) -> Optional[Receipt]:
+    session = router.session(user_id, fresh=True)
+
+    try:
+        receipt = insert_receipts(session, user_id, [data])[0]
+        session.commit()
+        response_cache.invalidate_user(user_id)
+        return receipt
+    except Exception as e:
+        logging.error(f'Error saving receipt data: {e}')
+        session.rollback()
+
+    return None
+
+def save_receipt_batch(records: List[Tuple[int, Dict]], user_id: int) -> List[Dict]:
+    """Save a chunk of validated receipts in one transaction.
+
+    Returns one result per record; if the transaction fails every record in
+    the chunk is reported as failed.
+    """
+    session = router.session(user_id, fresh=True)
+
+    try:
+        receipts = insert_receipts(session, user_id, [data for _, data in records])
+        session.commit()
+        response_cache.invalidate_user(user_id)
+        return [{'index': index, 'receipt_id': receipt.id}
+                for (index, _), receipt in zip(records, receipts)]
+    except Exception as e:
+        logging.error(f'Error saving receipt batch: {e}')
+        session.rollback()
+
+    return [{'index': index, 'error': 'Failed to save receipt data'} for index, _ in records]
+
+def iter_batch_records(req) -> Iterator[Tuple[int, Optional[Dict], Optional[str]]]:
+    """Yield (index, record, error) from a JSON array or NDJSON request body."""
+    if req.mimetype in NDJSON_MIMETYPES:
+        index = 0
+        for line in req.stream:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                yield index, None, 'Invalid JSON'
+            else:
+                if isinstance(record, dict):
+                    yield index, record, None
+                else:
+                    yield index, None, 'Expected a JSON object'
+            index += 1
+        return
+
+    data = req.get_json(silent=True)
+    if not isinstance(data, list):
+        raise ValueError('Expected a JSON array or NDJSON body')
+    for index, record in enumerate(data):
+        if isinstance(record, dict):
+            yield index, record, None
+        else:
+            yield index, None, 'Expected a JSON object'
+
+# Sharding
+class Shard:
+    """One receipts database with its own sessions and name caches."""
+
+    def __init__(self, index: int, shard_engine: db.engine.Engine):
+        self.index = index
+        self.engine = shard_engine
+        self.session = scoped_session(sessionmaker(bind=shard_engine, expire_on_commit=False, info={'shard': self}))
+        self.merchants = NameDictionary(Merchant, app.config['NAME_CACHE_SIZE'])
+        self.item_names = NameDictionary(ItemName, app.config['NAME_CACHE_SIZE'])
+        # Shard 0 is the main database and also holds users and the directory
+        self.search_enabled = migrate_schema(shard_engine, directory=index == 0)
+
+class ShardRouter:
+    """Routes each user's receipt data to one of several databases.
+
+    The main database holding the user_shards directory is shard 0 and each
+    of shard_urls adds another shard. New users are placed by a stable hash
+    of their id and the placement is recorded in the directory, so users can
+    later be moved by move_user(). Lookups are cached for directory_ttl
+    seconds.
+    """
+
+    def __init__(self, directory_engine: db.engine.Engine, shard_urls: List[str], directory_ttl: float):
+        urls = [directory_engine.url] + [db.engine.make_url(url) for url in shard_urls]
+        if len(set(urls)) != len(urls):
+            raise ValueError('SHARD_URLS must not repeat a url or include DATABASE_URL')
+
+        self.directory_engine = directory_engine
+        self.directory_ttl = directory_ttl
+        self.shards = [Shard(0, directory_engine)] + [
+            Shard(index, create_db_engine(url)) for index, url in enumerate(urls[1:], 1)
+        ]
+        self._directory = {}
+        self._lock = threading.Lock()
+
+    def home_shard(self, user_id: int) -> int:
+        return zlib.crc32(str(user_id).encode()) % len(self.shards)
+
+    def assign(self, session: Session, user_id: int) -> None:
+        """Record a new user's home shard in the caller's directory transaction."""
+        session.add(UserShard(user_id=user_id, shard=self.home_shard(user_id)))
+
+    def shard_for(self, user_id: int, fresh: bool = False) -> Shard:
+        """The user's shard, from the cache unless fresh is set.
+
+        Writes look up fresh so they never land on a shard the user has been
+        moved away from, see move_users().
+        """
+        if not fresh:
+            with self._lock:
+                cached = self._directory.get(user_id)
+            if cached is not None and cached[1] > time.monotonic():
+                return self.shards[cached[0]]
+
+        # Expiry counts from before the query, so no cached placement
+        # outlives a directory change by more than directory_ttl
+        started = time.monotonic()
+        session = Session(bind=self.directory_engine)
+        try:
+            index = session.query(UserShard.shard).filter_by(user_id=user_id).scalar()
+            if index is None:
+                index = self.home_shard(user_id)
+                session.execute(sqlite_insert(UserShard.__table__).on_conflict_do_nothing(),
+                                {'user_id': user_id, 'shard': index})
+                session.commit()
+        finally:
+            session.close()
+
+        with self._lock:
+            self._directory[user_id] = (index, started + self.directory_ttl)
+        return self.shards[index]
+
+    def session(self, user_id: int, fresh: bool = False) -> Session:
+        """The current thread's session on the user's shard."""
+        return self.shard_for(user_id, fresh).session()
+
+    def forget(self, user_id: int) -> None:
+        with self._lock:
+            self._directory.pop(user_id, None)
+
+    def remove_sessions(self) -> None:
+        for shard in self.shards:
+            shard.session.remove()
+
+    def dispose(self) -> None:
+        self.remove_sessions()
+        for shard in self.shards:
+            if shard.engine is not self.directory_engine:
+                shard.engine.dispose()
+
+def delete_user_receipts(session: Session, user_id: int) -> None:
+    """Delete all of a user's receipts, items, rollups and search documents."""
+    user_receipts = db.select(Receipt.id).where(Receipt.user_id == user_id)
+    if session.info['shard'].search_enabled:
+        session.execute(db.text(
+            'DELETE FROM receipt_search WHERE rowid IN (SELECT id FROM receipts WHERE user_id = :user_id)'
+        ), {'user_id': user_id})
+    session.execute(db.delete(Item.__table__).where(Item.receipt_id.in_(user_receipts)))
+    session.execute(db.delete(Receipt.__table__).where(Receipt.user_id == user_id))
+    session.execute(db.delete(ExpenseRollup.__table__).where(ExpenseRollup.user_id == user_id))
+
+def update_user_shard(user_id: int, **values) -> None:
+    """Update a user's directory entry in its own transaction."""
+    session = Session(bind=router.directory_engine)
+    try:
+        session.query(UserShard).filter_by(user_id=user_id).update(values)
+        session.commit()
+    finally:
+        session.close()
+    router.forget(user_id)
+
+def copy_receipts(user_id: int, source: Shard, target: Shard, after_id: int, chunk_size: int) -> Tuple[int, int]:
+    """Copy the user's source receipts with ids above after_id to target.
+
+    Returns how many were copied and the last source id copied (after_id if
+    none were).
+    """
+    source_session = source.session()
+    target_session = target.session()
+
+    copied = 0
+    last_id = after_id
+    chunk = []
+    query = source_session.query(Receipt).options(selectinload(Receipt.items)).filter(
+        Receipt.user_id == user_id, Receipt.id > after_id
+    ).order_by(Receipt.id)
+    for receipt in query.yield_per(chunk_size):
+        chunk.append({
+            'merchant': receipt.merchant,
+            'date': receipt.date,
+            'total': receipt.total,
+            'category': receipt.category,
+            'items': [{'name': item.name, 'quantity': item.quantity, 'price': item.price}
+                      for item in receipt.items],
+        })
+        last_id = receipt.id
+        if len(chunk) >= chunk_size:
+            insert_receipts(target_session, user_id, chunk)
+            target_session.commit()
+            copied += len(chunk)
+            chunk = []
+    if chunk:
+        insert_receipts(target_session, user_id, chunk)
+        target_session.commit()
+        copied += len(chunk)
+    # End the read transaction before writing to the directory
+    source_session.rollback()
+    return copied, last_id
+
+def finish_move(user_id: int, chunk_size: int) -> int:
+    """Complete or undo the user's unfinished move; returns how many receipts it copied.
+
+    A move that has not repointed the user yet is undone by deleting the
+    partial copy from its target. A repointed move first copies over the
+    receipts uploaded to the source since its copy began, then deletes the
+    source's rows; callers must have waited SHARD_DIRECTORY_TTL since the
+    repoint.
+    """
+    session = Session(bind=router.directory_engine)
+    try:
+        entry = session.get(UserShard, user_id)
+    finally:
+        session.close()
+    if entry is None or entry.stale_shard is None:
+        return 0
+
+    copied = 0
+    if entry.stale_shard != entry.shard:
+        stale = router.shards[entry.stale_shard]
+        if entry.copied_through is not None:
+            copied, last_id = copy_receipts(
+                user_id, stale, router.shards[entry.shard], entry.copied_through, chunk_size
+            )
+            update_user_shard(user_id, copied_through=last_id)
+        stale_session = stale.session()
+        delete_user_receipts(stale_session, user_id)
+        stale_session.commit()
+
+    update_user_shard(user_id, stale_shard=None, copied_through=None)
+    response_cache.invalidate_user(user_id)
+    return copied
+
+def start_move(user_id: int, target_index: int, chunk_size: int) -> int:
+    """Copy a user's receipts to another shard and repoint the directory.
+
+    The source keeps its rows, recorded as the stale shard, until
+    finish_move(). Returns how many receipts were copied.
+    """
+    session = Session(bind=router.directory_engine)
+    try:
+        entry = session.get(UserShard, user_id)
+        repointed = entry is not None and entry.copied_through is not None
+    finally:
+        session.close()
+    if repointed:
+        # An earlier run stopped after its repoint; when is unknown
+        time.sleep(router.directory_ttl)
+    moved = finish_move(user_id, chunk_size)
+
+    source = router.shard_for(user_id, fresh=True)
+    target = router.shards[target_index]
+    if source is target:
+        return moved
+
+    update_user_shard(user_id, stale_shard=target_index)
+    copied, last_id = copy_receipts(user_id, source, target, 0, chunk_size)
+    update_user_shard(user_id, shard=target_index, stale_shard=source.index, copied_through=last_id)
+    response_cache.invalidate_user(user_id)
+    return moved + copied
+
+def move_users(moves: List[Tuple[int, int]], chunk_size: int) -> List[int]:
+    """Move the receipts of each (user_id, shard) pair; returns how many moved per pair.
+
+    Each user's receipts are copied to the target while the source keeps
+    serving, then one directory update points the user at the target and
+    marks the source stale. Writes always read the directory, but other app
+    processes may read from the source on a cached placement for up to
+    SHARD_DIRECTORY_TTL, so the source rows are kept that long. After that
+    the receipts uploaded to the source during the copy are copied over and
+    the source rows are deleted. Every user is repointed before the wait, so
+    it is paid once per call.
+
+    A move interrupted at any point is finished or undone by running it
+    again; a crash right after copying the late uploads copies them twice.
+    Receipt ids are allocated by the target shard, so they change.
+    """
+    moved = [start_move(user_id, target_index, chunk_size) for user_id, target_index in moves]
+    time.sleep(router.directory_ttl)
+    return [count + finish_move(user_id, chunk_size) for count, (user_id, _) in zip(moved, moves)]
+
+def move_user(user_id: int, target_index: int, chunk_size: int) -> int:
+    """Move one user's receipts to another shard, see move_users()."""
+    return move_users([(user_id, target_index)], chunk_size)[0]
+
+# Bulk export
+EXPORT_COLUMNS = ('receipt_id', 'date', 'merchant', 'category', 'total', 'item_name', 'item_quantity', 'item_price')
+
+def iter_export_rows(session: Session, user_id: int, chunk_size: int) -> Iterator[List]:
+    """Yield a user's receipts joined with their items, chunk_size rows at a time.
+
+    Rows are streamed from the database cursor so memory use does not depend
+    on the size of the user's history. Receipts without items get one row
+    with empty item columns.
+    """
+    stmt = db.select(
+        Receipt.id, Receipt.date, Merchant.name, Receipt.category, Receipt.total,
+        ItemName.name, Item.quantity, Item.price,
+    ).join(Merchant, Merchant.id == Receipt.merchant_id).outerjoin(
+        Item, Item.receipt_id == Receipt.id
+    ).outerjoin(ItemName, ItemName.id == Item.name_id).where(
+        Receipt.user_id == user_id
+    ).order_by(Receipt.date, Receipt.id, Item.id)
+
+    result = session.execute(stmt.execution_options(yield_per=chunk_size))
+    for partition in result.partitions():
+        yield partition
+
+def write_csv(chunks: Iterable[List]) -> Iterator[bytes]:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_COLUMNS)
+    for rows in chunks:
+        writer.writerows(
+            (receipt_id, receipt_date.date().isoformat(), *rest) for receipt_id, receipt_date, *rest in rows
+        )
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode()
+
+def write_ndjson(chunks: Iterable[List]) -> Iterator[bytes]:
+    for rows in chunks:
+        yield ''.join(
+            json.dumps(dict(zip(EXPORT_COLUMNS, (row[0], row[1].date().isoformat(), *row[2:])))) + '\n'
+            for row in rows
+        ).encode()
+
+def write_arrow(chunks: Iterable[List]) -> Iterator[bytes]:
+    """Write an Arrow IPC stream with one record batch per chunk."""
+    schema = pa.schema([
+        ('receipt_id', pa.int64()),
+        ('date', pa.date32()),
+        ('merchant', pa.string()),
+        ('category', pa.string()),
+        ('total', pa.float64()),
+        ('item_name', pa.string()),
+        ('item_quantity', pa.string()),
+        ('item_price', pa.float64()),
+    ])
+    sink = io.BytesIO()
+    with pa.ipc.new_stream(sink, schema) as writer:
+        for rows in chunks:
+            columns = [list(column) for column in zip(*rows)]
+            columns[1] = [receipt_date.date() for receipt_date in columns[1]]
+            writer.write_batch(pa.record_batch(columns, schema=schema))
+            yield sink.getvalue()
+            sink.seek(0)
+            sink.truncate()
+    yield sink.getvalue()
+
+# format -> (mimetype, file extension, writer)
+EXPORT_FORMATS = {
+    'csv': ('text/csv', 'csv', write_csv),
+    'ndjson': ('application/x-ndjson', 'ndjson', write_ndjson),
+    'arrow': ('application/vnd.apache.arrow.stream', 'arrows', write_arrow),
+}
+
+# Asynchronous ingestion
+class IngestQueue:
+    """Bounded write-behind queue that commits receipts in groups.
+
+    Workers take the first waiting receipt, keep collecting until group_size
+    receipts or group_window seconds have passed, and commit the whole group
+    in one transaction. Each submission gets a ticket whose status can be
+    polled until it resolves to a receipt id or an error. Tickets are held in
+    this process's memory only.
+    """
+
+    def __init__(self, workers: int, max_size: int, group_size: int, group_window: float, ticket_limit: int):
+        self.workers = workers
+        self.group_size = group_size
+        self.group_window = group_window
+        self.ticket_limit = ticket_limit
+        self._queue = queue.Queue(maxsize=max_size)
+        self._tickets = OrderedDict()
+        self._lock = threading.Lock()
+        self._threads = []
+        # Guards _stopping and _submitting so shutdown() only sends the stop
+        # sentinels once no submission can still be enqueued behind them.
+        self._accepting = threading.Condition()
+        self._stopping = False
+        self._submitting = 0
+
+    def start(self) -> None:
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f'ingest-worker-{i}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def depth(self) -> int:
+        return self._queue.qsize()
+
+    def submit(self, user_id: int, receipt: Dict, timeout: float) -> str:
+        """Enqueue a validated receipt and return its ticket id.
+
+        Blocks for up to timeout seconds when the queue is full, then raises
+        queue.Full so the caller can push back on the client.
+        """
+        with self._accepting:
+            if self._stopping:
+                raise queue.Full
+            self._submitting += 1
+
+        try:
+            ticket_id = uuid.uuid4().hex
+            with self._lock:
+                self._tickets[ticket_id] = {'user_id': user_id, 'status': 'pending'}
+                while len(self._tickets) > self.ticket_limit:
+                    self._tickets.popitem(last=False)
+
+            try:
+                self._queue.put((ticket_id, user_id, receipt), timeout=timeout)
+            except queue.Full:
+                with self._lock:
+                    self._tickets.pop(ticket_id, None)
+                raise
+            return ticket_id
+        finally:
+            with self._accepting:
+                self._submitting -= 1
+                self._accepting.notify_all()
+
+    def status(self, ticket_id: str) -> Optional[Dict]:
+        with self._lock:
+            ticket = self._tickets.get(ticket_id)
+            return dict(ticket) if ticket else None
+
+    def shutdown(self) -> None:
+        """Stop accepting receipts and wait for queued ones to be committed."""
+        with self._accepting:
+            self._stopping = True
+            self._accepting.wait_for(lambda: not self._submitting)
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def _run(self) -> None:
+        while True:
+            entry = self._queue.get()
+            if entry is None:
+                return
+
+            group = [entry]
+            stop = False
+            deadline = time.monotonic() + self.group_window
+            while len(group) < self.group_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    entry = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if entry is None:
+                    stop = True
+                    break
+                group.append(entry)
+
+            try:
+                for shard, entries in self._group_by_shard(group).items():
+                    try:
+                        self._commit_group(shard, entries)
+                    except Exception as e:
+                        logging.error(f'Error committing ingest group on shard {shard.index}: {e}')
+                        self._fail_pending(ticket_id for ticket_id, _, _ in entries)
+            finally:
+                router.remove_sessions()
+                db_session.remove()
+            if stop:
+                return
+
+    def _group_by_shard(self, group: List[Tuple[str, int, Dict]]) -> Dict[Shard, List[Tuple[str, int, Dict]]]:
+        """Split a group by shard, failing the tickets whose shard lookup fails."""
+        by_shard = {}
+        shards = {}
+        for ticket_id, user_id, receipt in group:
+            shard = shards.get(user_id)
+            if shard is None:
+                try:
+                    shard = shards[user_id] = router.shard_for(user_id, fresh=True)
+                except Exception as e:
+                    logging.error(f'Error looking up shard of user {user_id}: {e}')
+                    self._fail_pending([ticket_id])
+                    continue
+            by_shard.setdefault(shard, []).append((ticket_id, user_id, receipt))
+        return by_shard
+
+    def _commit_group(self, shard: Shard, group: List[Tuple[str, int, Dict]]) -> None:
+        by_user = {}
+        for ticket_id, user_id, receipt in group:
+            by_user.setdefault(user_id, []).append((ticket_id, receipt))
+
+        session = shard.session()
+        try:
+            results = {}
+            for user_id, entries in by_user.items():
+                receipts = insert_receipts(session, user_id, [receipt for _, receipt in entries])
+                results.update((ticket_id, receipt) for (ticket_id, _), receipt in zip(entries, receipts))
+            session.commit()
+        except Exception as e:
+            logging.error(f'Error committing ingest group of {len(group)}, retrying individually: {e}')
+            session.rollback()
+            for ticket_id, user_id, receipt in group:
+                saved = save_receipt_data(receipt, user_id)
+                if saved:
+                    self._resolve(ticket_id, {'status': 'done', 'receipt_id': saved.id})
+                else:
+                    self._resolve(ticket_id, {'status': 'failed', 'error': 'Failed to save receipt data'})
+            return
+
+        for user_id in by_user:
+            response_cache.invalidate_user(user_id)
+        for ticket_id, receipt in results.items():
+            self._resolve(ticket_id, {'status': 'done', 'receipt_id': receipt.id})
+
+    def _resolve(self, ticket_id: str, result: Dict) -> None:
+        with self._lock:
+            ticket = self._tickets.get(ticket_id)
+            if ticket is not None:
+                ticket.update(result)
+
+    def _fail_pending(self, ticket_ids: Iterable[str]) -> None:
+        with self._lock:
+            for ticket_id in ticket_ids:
+                ticket = self._tickets.get(ticket_id)
+                if ticket is not None and ticket['status'] == 'pending':
+                    ticket.update({'status': 'failed', 'error': 'Failed to save receipt data'})
+
+# Response caching
+class CacheEntry(NamedTuple):
+    body: bytes
+    mimetype: str
+    etag: str
+    expires_at: float
+
+class ResponseCache:
+    """Thread-safe LRU cache of rendered responses, invalidated per user.
+
+    Entries expire after ttl seconds and the cache evicts least recently used
+    entries once it holds more than max_entries or max_bytes of bodies. The
+    cache is per process: invalidate_user() only reaches this process, so
+    other workers may serve a user's stale entries until they expire.
+    """
+
+    def __init__(self, max_entries: int, max_bytes: int, ttl: float):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._user_keys = {}
+        self._generations = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def generation(self, user_id: int) -> int:
+        with self._lock:
+            return self._generations.get(user_id, 0)
+
+    def get(self, key: Tuple[int, Hashable]) -> Optional[CacheEntry]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.expires_at <= time.monotonic():
+                self._remove(key)
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def set(self, key: Tuple[int, Hashable], body: bytes, mimetype: str, generation: int) -> CacheEntry:
+        """Store a response body and return its entry.
+
+        The body is not stored if the user's data was invalidated since
+        generation was read, so a slow request can't cache stale data.
+        """
+        user_id = key[0]
+        entry = CacheEntry(body, mimetype, hashlib.blake2b(body, digest_size=16).hexdigest(),
+                           time.monotonic() + self.ttl)
+
+        with self._lock:
+            if generation != self._generations.get(user_id, 0) or len(body) > self.max_bytes:
+                return entry
+
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = entry
+            self._user_keys.setdefault(user_id, set()).add(key)
+            self._bytes += len(body)
+
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+        return entry
+
+    def invalidate_user(self, user_id: int) -> None:
+        with self._lock:
+            self._generations[user_id] = self._generations.get(user_id, 0) + 1
+            for key in self._user_keys.pop(user_id, ()):
+                entry = self._entries.pop(key, None)
+                if entry is not None:
+                    self._bytes -= len(entry.body)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+            }
+
+    def _remove(self, key: Tuple[int, Hashable]) -> None:
+        entry = self._entries.pop(key)
+        self._bytes -= len(entry.body)
+        user_keys = self._user_keys.get(key[0])
+        if user_keys is not None:
+            user_keys.discard(key)
+            if not user_keys:
+                del self._user_keys[key[0]]
+
+def cached_response(view):
+    """Cache a view's 200 responses per user and query, with ETag support.
+
+    Clients that send a matching If-None-Match get a 304 straight from the
+    cache without touching the database.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        user_id = get_jwt_identity()
+        key = (user_id, (request.path, tuple(sorted(request.args.items(multi=True)))))
+
+        entry = response_cache.get(key)
+        if entry is None:
+            generation = response_cache.generation(user_id)
+            response = app.make_response(view(*args, **kwargs))
+            if response.status_code != 200:
+                return response
+            entry = response_cache.set(key, response.get_data(), response.mimetype, generation)
+
+        response = Response(entry.body, mimetype=entry.mimetype)
+        response.set_etag(entry.etag)
+        response.headers['Cache-Control'] = 'private, no-cache'
+        return response.make_conditional(request)
+
+    return wrapper
+
+# Instrumentation
+class Histogram:
+    """Cumulative-bucket histogram in the Prometheus style."""
+
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name: str, labels: Dict[str, str]) -> List[str]:
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            cumulative += count
+            le = '+Inf' if bound == float('inf') else repr(bound)
+            lines.append(f"{name}_bucket{format_labels({**labels, 'le': le})} {cumulative}")
+        lines.append(f'{name}_sum{format_labels(labels)} {self.sum}')
+        lines.append(f'{name}_count{format_labels(labels)} {self.count}')
+        return lines
+
+def format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ''
+    escaped = (
+        f'{key}="' + str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+        for key, value in labels.items()
+    )
+    return '{' + ','.join(escaped) + '}'
+
+class Metrics:
+    """Process-wide request, query and session statistics.
+
+    Fed by Flask request hooks and SQLAlchemy engine and session events, and
+    rendered in the Prometheus text exposition format by /metrics.
+    """
+
+    LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+    QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+    def __init__(self, slow_query_threshold: float):
+        self.slow_query_threshold = slow_query_threshold
+        self.request_latency = {}
+        self.request_queries = {}
+        self.request_query_time = {}
+        self.requests_total = {}
+        self.query_latency = Histogram(self.LATENCY_BUCKETS)
+        self.slow_queries = 0
+        self.transactions = {'begin': 0, 'commit': 0, 'rollback': 0}
+        self._lock = threading.Lock()
+
+    def observe_request(self, endpoint: str, method: str, status: int, duration: float,
+                        queries: int, query_time: float) -> None:
+        with self._lock:
+            key = (endpoint, method)
+            if key not in self.request_latency:
+                self.request_latency[key] = Histogram(self.LATENCY_BUCKETS)
+                self.request_queries[key] = Histogram(self.QUERY_COUNT_BUCKETS)
+                self.request_query_time[key] = 0.0
+            self.request_latency[key].observe(duration)
+            self.request_queries[key].observe(queries)
+            self.request_query_time[key] += query_time
+
+            status_key = (endpoint, method, str(status))
+            self.requests_total[status_key] = self.requests_total.get(status_key, 0) + 1
+
+    def observe_query(self, statement: str, duration: float) -> None:
+        slow = duration >= self.slow_query_threshold
+        with self._lock:
+            self.query_latency.observe(duration)
+            if slow:
+                self.slow_queries += 1
+        if slow:
+            logging.warning(f'Slow query ({duration * 1000:.1f} ms): {statement}')
+
+    def observe_transaction(self, outcome: str) -> None:
+        with self._lock:
+            self.transactions[outcome] += 1
+
+    def render(self) -> str:
+        lines = []
+
+        def family(name: str, kind: str, help_text: str) -> None:
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+
+        with self._lock:
+            family('receipts_http_requests_total', 'counter', 'HTTP requests by endpoint, method and status.')
+            for (endpoint, method, status), count in sorted(self.requests_total.items()):
+                labels = {'endpoint': endpoint, 'method': method, 'status': status}
+                lines.append(f'receipts_http_requests_total{format_labels(labels)} {count}')
+
+            family('receipts_http_request_duration_seconds', 'histogram', 'Time to produce a response.')
+            for (endpoint, method), histogram in sorted(self.request_latency.items()):
+                lines.extend(histogram.render('receipts_http_request_duration_seconds',
+                                              {'endpoint': endpoint, 'method': method}))
+
+            family('receipts_http_request_queries', 'histogram', 'SQL queries issued per request.')
+            for (endpoint, method), histogram in sorted(self.request_queries.items()):
+                lines.extend(histogram.render('receipts_http_request_queries',
+                                              {'endpoint': endpoint, 'method': method}))
+
+            family('receipts_http_request_query_seconds_total', 'counter', 'Time spent in SQL by requests.')
+            for (endpoint, method), total in sorted(self.request_query_time.items()):
+                labels = {'endpoint': endpoint, 'method': method}
+                lines.append(f'receipts_http_request_query_seconds_total{format_labels(labels)} {total}')
+
+            family('receipts_db_query_duration_seconds', 'histogram', 'SQL statement execution time.')
+            lines.extend(self.query_latency.render('receipts_db_query_duration_seconds', {}))
+
+            family('receipts_db_slow_queries_total', 'counter', 'SQL statements over the slow query threshold.')
+            lines.append(f'receipts_db_slow_queries_total {self.slow_queries}')
+
+            family('receipts_db_transactions_total', 'counter', 'Session transactions by outcome.')
+            for outcome, count in self.transactions.items():
+                lines.append(f"receipts_db_transactions_total{format_labels({'outcome': outcome})} {count}")
+
+        pools = [('main', engine.pool)] + [
+            (f'shard{shard.index}', shard.engine.pool) for shard in router.shards if shard.engine is not engine
+        ]
+        family('receipts_db_pool_size', 'gauge', 'Configured connection pool size.')
+        for database, pool in pools:
+            if hasattr(pool, 'size'):
+                lines.append(f"receipts_db_pool_size{format_labels({'database': database})} {pool.size()}")
+        family('receipts_db_pool_connections', 'gauge', 'Pooled database connections by state.')
+        for database, pool in pools:
+            for state, stat in (('checked_out', 'checkedout'), ('checked_in', 'checkedin'), ('overflow', 'overflow')):
+                if hasattr(pool, stat):
+                    labels = {'database': database, 'state': state}
+                    lines.append(f'receipts_db_pool_connections{format_labels(labels)} {getattr(pool, stat)()}')
+
+        cache_stats = response_cache.stats()
+        for stat in ('hits', 'misses', 'evictions'):
+            family(f'receipts_response_cache_{stat}_total', 'counter', f'Response cache {stat}.')
+            lines.append(f'receipts_response_cache_{stat}_total {cache_stats[stat]}')
+        if ingest_queue is not None:
+            family('receipts_ingest_queue_depth', 'gauge', 'Receipts waiting to be committed.')
+            lines.append(f'receipts_ingest_queue_depth {ingest_queue.depth()}')
+
+        family('receipts_response_cache_entries', 'gauge', 'Responses currently cached.')
+        lines.append(f"receipts_response_cache_entries {cache_stats['entries']}")
+        family('receipts_response_cache_bytes', 'gauge', 'Bytes of cached response bodies.')
+        lines.append(f"receipts_response_cache_bytes {cache_stats['bytes']}")
+
+        return '\n'.join(lines) + '\n'
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start_time', []).append(time.perf_counter())
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    duration = time.perf_counter() - conn.info['query_start_time'].pop()
+    metrics.observe_query(statement, duration)
+    if has_request_context() and 'query_count' in g:
+        g.query_count += 1
+        g.query_time += duration
+
+def handle_query_error(context):
+    # A failed statement never reaches after_cursor_execute
+    if context.connection is not None and context.connection.info.get('query_start_time'):
+        context.connection.info['query_start_time'].pop()
+
+def instrument_engine(target_engine: db.engine.Engine) -> None:
+    event.listen(target_engine, 'before_cursor_execute', before_cursor_execute)
+    event.listen(target_engine, 'after_cursor_execute', after_cursor_execute)
+    event.listen(target_engine, 'handle_error', handle_query_error)
+
+event.listen(Session, 'after_begin', lambda session, transaction, connection: metrics.observe_transaction('begin'))
+event.listen(Session, 'after_commit', lambda session: metrics.observe_transaction('commit'))
+event.listen(Session, 'after_rollback', lambda session: metrics.observe_transaction('rollback'))
+
+# API setup
+app = Flask(__name__)
+app.config['JWT_SECRET_KEY'] = 'your-secret-key'
+app.config['BATCH_CHUNK_SIZE'] = 500
+app.config['DEFAULT_PAGE_SIZE'] = 100
+app.config['MAX_PAGE_SIZE'] = 1000
+app.config['STREAM_BATCH_SIZE'] = 100
+app.config['EXPORT_CHUNK_SIZE'] = 5000
+jwt = JWTManager(app)
+
+app.config['DATABASE_URL'] = 'sqlite:///receipts.db'
+app.config['DATABASE_POOL_SIZE'] = 10
+app.config['DATABASE_MAX_OVERFLOW'] = 20
+app.config['DATABASE_TIMEOUT'] = 30
+app.config['SQLITE_PRAGMAS'] = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'cache_size': -64000,  # KiB, i.e. 64 MB per connection
+    'mmap_size': 268435456,
+    'temp_store': 'MEMORY',
+}
+app.config['NAME_CACHE_SIZE'] = 100000
+app.config['RESPONSE_CACHE_MAX_ENTRIES'] = 10000
+app.config['RESPONSE_CACHE_MAX_BYTES'] = 64 * 1024 * 1024
+app.config['RESPONSE_CACHE_TTL'] = 30  # per process, see ResponseCache
+app.config['SLOW_QUERY_THRESHOLD_MS'] = 200
+app.config['ASYNC_INGEST'] = False
+app.config['INGEST_WORKERS'] = 2
+app.config['INGEST_QUEUE_SIZE'] = 10000
+app.config['INGEST_GROUP_SIZE'] = 200
+app.config['INGEST_GROUP_WINDOW_MS'] = 20
+app.config['INGEST_ENQUEUE_TIMEOUT'] = 1.0
+app.config['INGEST_TICKET_LIMIT'] = 100000
+app.config['SHARD_URLS'] = []
+app.config['SHARD_DIRECTORY_TTL'] = 60
+# e.g. RECEIPTS_DATABASE_URL=sqlite:////var/lib/receipts.db
+#      RECEIPTS_SHARD_URLS='["sqlite:////var/lib/receipts-0.db", "sqlite:////var/lib/receipts-1.db"]'
+app.config.from_prefixed_env('RECEIPTS')
+
+metrics = Metrics(app.config['SLOW_QUERY_THRESHOLD_MS'] / 1000)
+configure_database()
+
+response_cache = ResponseCache(
+    app.config['RESPONSE_CACHE_MAX_ENTRIES'],
+    app.config['RESPONSE_CACHE_MAX_BYTES'],
+    app.config['RESPONSE_CACHE_TTL'],
+)
+
+ingest_queue = None
+if app.config['ASYNC_INGEST']:
+    ingest_queue = IngestQueue(
+        app.config['INGEST_WORKERS'],
+        app.config['INGEST_QUEUE_SIZE'],
+        app.config['INGEST_GROUP_SIZE'],
+        app.config['INGEST_GROUP_WINDOW_MS'] / 1000,
+        app.config['INGEST_TICKET_LIMIT'],
+    )
+    ingest_queue.start()
+    atexit.register(ingest_queue.shutdown)
+
+@app.teardown_appcontext
+def remove_db_session(exception=None):
+    router.remove_sessions()
+    db_session.remove()
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    g.query_count = 0
+    g.query_time = 0.0
+
+@app.after_request
+def record_request_metrics(response):
+    """Observe the request, deferring streamed responses until closed.
+
+    Streamed bodies are generated after this hook returns, so their time and
+    queries are only complete when the server closes the response.
+    """
+    if 'request_started' in g:
+        state = g._get_current_object()
+        endpoint = request.endpoint or 'unmatched'
+        method = request.method
+
+        def observe():
+            metrics.observe_request(
+                endpoint, method, response.status_code,
+                time.perf_counter() - state.request_started, state.query_count, state.query_time,
+            )
+
+        if response.is_streamed:
+            response.call_on_close(observe)
+        else:
+            observe()
+    return response
+
+NDJSON_MIMETYPES = ('application/x-ndjson', 'application/ndjson', 'application/jsonl')
+
+@app.route('/register', methods=['POST'])
+def register():
+    data = request.get_json()
+    username = data.get('username')
+    password = data.get('password')
+
+    if not username or not password:
+        return jsonify({'error': 'Username and password are required'}), 400
+
+    session = db_session()
+    try:
+        existing_user = session.query(User).filter_by(username=username).first()
+        if existing_user:
+            return jsonify({'error': 'Username already exists'}), 400
+
+        user = User(username=username, password=password)
+        session.add(user)
+        session.flush()
+        router.assign(session, user.id)
+        session.commit()
+        return jsonify({'message': 'User registered successfully'}), 201
+    except Exception as e:
+        logging.error(f'Error registering user: {e}')
+        session.rollback()
+        return jsonify({'error': 'Internal server error'}), 500
+
+@app.route('/login', methods=['POST'])
+def login():
+    data = request.get_json()
+    username = data.get('username')
+    password = data.get('password')
+
+    if not username or not password:
+        return jsonify({'error': 'Username and password are required'}), 400
+
+    session = db_session()
+    try:
+        user = session.query(User).filter_by(username=username, password=password).first()
+        if not user:
+            return jsonify({'error': 'Invalid username or password'}), 401
+
+        # Warm the shard lookup for the requests that follow
+        router.shard_for(user.id)
+        access_token = create_access_token(identity=str(user.id))
+        return jsonify({'access_token': access_token}), 200
+    except Exception as e:
+        logging.error(f'Error logging in user: {e}')
+        return jsonify({'error': 'Internal server error'}), 500
+
+@app.route('/receipts', methods=['POST'])
+@jwt_required()
+def upload_receipt():
+    user_id = get_jwt_identity()
+    data = request.get_json(silent=True)
+
+    validated_data, errors = receipt_validator.validate(data)
+    if errors:
+        return jsonify({'error': 'Invalid receipt data', 'errors': errors}), 400
+
+    if ingest_queue is not None:
+        try:
+            ticket_id = ingest_queue.submit(user_id, validated_data, app.config['INGEST_ENQUEUE_TIMEOUT'])
+        except queue.Full:
+            return jsonify({'error': 'Ingestion queue is full, retry later'}), 503, {'Retry-After': '1'}
+        return jsonify({'message': 'Receipt accepted', 'ticket_id': ticket_id}), 202
+
+    receipt = save_receipt_data(validated_data, user_id)
+    if not receipt:
+        return jsonify({'error': 'Failed to save receipt data'}), 500
+
+    return jsonify({'message': 'Receipt uploaded successfully', 'receipt_id': receipt.id}), 201
+
+@app.route('/receipts/tickets/<ticket_id>', methods=['GET'])
+@jwt_required()
+def get_ingest_ticket(ticket_id):
+    user_id = get_jwt_identity()
+    ticket = ingest_queue.status(ticket_id) if ingest_queue is not None else None
+    if not ticket or ticket.pop('user_id') != user_id:
+        # Tickets only live in the accepting process, see IngestQueue
+        return jsonify({
+            'ticket_id': ticket_id,
+            'status': 'unknown',
+            'error': 'Ticket not known to this process; it may belong to another worker or predate a restart',
+        }), 404
+
+    return jsonify({'ticket_id': ticket_id, **ticket}), 200
+
+@app.route('/receipts/batch', methods=['POST'])
+@jwt_required()
+def upload_receipt_batch():
+    user_id = get_jwt_identity()
+    chunk_size = app.config['BATCH_CHUNK_SIZE']
+
+    results = []
+    chunk = []
+
+    def save_chunk():
+        valid, invalid = receipt_validator.validate_many(chunk)
+        results.extend({'index': record['index'], 'error': 'Invalid receipt data', 'errors': record['errors']}
+                       for record in invalid)
+        if valid:
+            results.extend(save_receipt_batch(valid, user_id))
+        chunk.clear()
+
+    try:
+        for index, record, error in iter_batch_records(request):
+            if error:
+                results.append({'index': index, 'error': error})
+                continue
+
+            chunk.append((index, record))
+            if len(chunk) >= chunk_size:
+                save_chunk()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    if chunk:
+        save_chunk()
+
+    if not results:
+        return jsonify({'error': 'No receipts provided'}), 400
+
+    results.sort(key=lambda result: result['index'])
+    failed = sum(1 for result in results if 'error' in result)
+    body = {'inserted': len(results) - failed, 'failed': failed, 'results': results}
+    return jsonify(body), 201 if not failed else 207
+
+@app.route('/receipts/<int:receipt_id>', methods=['GET'])
+@jwt_required()
+@cached_response
+def get_receipt(receipt_id):
+    user_id = get_jwt_identity()
+    session = router.session(user_id)
+
+    try:
+        receipt = session.query(Receipt).options(selectinload(Receipt.items)).filter_by(
+            id=receipt_id, user_id=user_id
+        ).first()
+        if not receipt:
+            return jsonify({'error': 'Receipt not found'}), 404
+
+        receipt_data = receipt.serialize(include_items=True)
+        return jsonify(receipt_data), 200
+    except Exception as e:
+        logging.error(f'Error retrieving receipt data: {e}')
+        return jsonify({'error': 'Internal server error'}), 500
+
+# Helper function to get JWT identity
+def get_jwt_identity():
+    return int(current_identity())
+
+def parse_limit_arg() -> int:
+    """Read the page size query argument, clamped to MAX_PAGE_SIZE."""
+    limit = request.args.get('limit', app.config['DEFAULT_PAGE_SIZE'], type=int)
+    return max(1, min(limit, app.config['MAX_PAGE_SIZE']))
+
+def encode_cursor(receipt: Receipt) -> str:
+    raw = f'{receipt.date.isoformat()}|{receipt.id}'
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+def decode_cursor(cursor: str) -> Tuple[datetime, int]:
+    try:
+        date_str, receipt_id = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+        return datetime.fromisoformat(date_str), int(receipt_id)
+    except (ValueError, UnicodeDecodeError):
+        raise ValueError('Invalid cursor')
+
 @app.route('/receipts', methods=['GET'])
 @jwt_required()
 def get_receipts():
+    """List receipts newest first, one keyset-paginated page at a time.
+
+    The page is streamed as it is read from the database; pass the returned
+    next_cursor back as ?cursor= to fetch the following page.
+    """
     user_id = get_jwt_identity()
-    session = Session(bind=engine)
-    receipts = session.query(Receipt).filter(Receipt.user_id == user_id).all()
-    session.close()
-    return jsonify([receipt.serialize() for receipt in receipts])
+    limit = parse_limit_arg()
+    include_items = request.args.get('include_items', '').lower() in ('1', 'true', 'yes')
 
-@app.route('/receipts/<int:receipt_id>', methods=['GET'])
+    cursor = request.args.get('cursor')
+    if cursor:
+        try:
+            cursor = decode_cursor(cursor)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+
+    def generate():
+        session = router.session(user_id)
+        query = session.query(Receipt).filter(Receipt.user_id == user_id)
+        if cursor:
+            query = query.filter(db.tuple_(Receipt.date, Receipt.id) < cursor)
+        if include_items:
+            query = query.options(selectinload(Receipt.items))
+        query = query.order_by(Receipt.date.desc(), Receipt.id.desc()).limit(limit + 1)
+
+        yield '{"receipts": ['
+        last = None
+        has_more = False
+        for count, receipt in enumerate(query.yield_per(app.config['STREAM_BATCH_SIZE'])):
+            if count == limit:
+                has_more = True
+                break
+            yield (',' if last else '') + json.dumps(receipt.serialize(include_items))
+            last = receipt
+        next_cursor = encode_cursor(last) if has_more else None
+        yield '], "next_cursor": ' + json.dumps(next_cursor) + '}'
+
+    return Response(stream_with_context(generate()), mimetype='application/json')
+
+def build_search_query(text: str) -> Optional[str]:
+    """Turn free text into an FTS5 query matching every word as a prefix."""
+    words = re.findall(r'\w+', text)[:10]
+    if not words:
+        return None
+    return ' AND '.join(f'"{word}"*' for word in words)
+
+@app.route('/receipts/search', methods=['GET'])
 @jwt_required()
-def get_receipt_details(receipt_id):
+def search_receipts():
+    """Find receipts whose merchant or item names match every word of q.
+
+    Results are ordered by relevance (merchant matches weigh more than item
+    matches) and paginated with limit/offset.
+    """
     user_id = get_jwt_identity()
-    session = Session(bind=engine)
-    receipt = session.query(Receipt).filter(Receipt.id == receipt_id, Receipt.user_id == user_id).first()
-    session.close()
-    if receipt:
-        return jsonify(receipt.serialize())
-    else:
-        return jsonify({'message': 'Receipt not found'}), 404
-    
+    shard = router.shard_for(user_id)
+    if not shard.search_enabled:
+        return jsonify({'error': 'Search is not available'}), 501
+
+    search_query = build_search_query(request.args.get('q', ''))
+    if not search_query:
+        return jsonify({'error': 'Search query is required'}), 400
 
-from datetime import datetime
+    limit = parse_limit_arg()
+    offset = max(0, request.args.get('offset', 0, type=int))
+
+    sql = ('SELECT receipt_search.rowid FROM receipt_search '
+           'JOIN receipts ON receipts.id = receipt_search.rowid '
+           'WHERE receipt_search MATCH :query')
+    # The column filter keeps the user's words from matching owner tokens
+    params = {
+        'query': f'owner:"u{user_id}" AND {{merchant items}} : ({search_query})',
+        'limit': limit,
+        'offset': offset,
+    }
+    date_params = []
+    for name, operator in (('start_date', '>='), ('end_date', '<=')):
+        if not request.args.get(name):
+            continue
+        try:
+            params[name] = datetime.strptime(request.args[name], '%Y-%m-%d')
+        except ValueError:
+            return jsonify({'message': 'Invalid date format, use YYYY-MM-DD'}), 400
+        sql += f' AND receipts.date {operator} :{name}'
+        date_params.append(db.bindparam(name, type_=DateTime))
+    sql += ' ORDER BY bm25(receipt_search, 0.0, 2.0, 1.0) LIMIT :limit OFFSET :offset'
+
+    session = shard.session()
+    receipt_ids = session.execute(db.text(sql).bindparams(*date_params), params).scalars().all()
+
+    receipts = session.query(Receipt).options(selectinload(Receipt.items)).filter(Receipt.id.in_(receipt_ids)).all()
+    receipts_by_id = {receipt.id: receipt for receipt in receipts}
+    results = [receipts_by_id[receipt_id].serialize(include_items=True)
+               for receipt_id in receipt_ids if receipt_id in receipts_by_id]
+
+    next_offset = offset + limit if len(receipt_ids) == limit else None
+    return jsonify({'results': results, 'next_offset': next_offset}), 200
+
+@app.route('/receipts/export', methods=['GET'])
+@jwt_required()
+def export_receipts():
+    """Stream the user's full receipt history as csv, ndjson or arrow."""
+    user_id = get_jwt_identity()
+    export_format = request.args.get('format', 'csv')
+    if export_format not in EXPORT_FORMATS:
+        return jsonify({'error': f"Unsupported format, use one of: {', '.join(EXPORT_FORMATS)}"}), 400
+    if export_format == 'arrow' and pa is None:
+        return jsonify({'error': 'Arrow export requires pyarrow'}), 501
+
+    mimetype, extension, writer = EXPORT_FORMATS[export_format]
+
+    def generate():
+        yield from writer(iter_export_rows(router.session(user_id), user_id, app.config['EXPORT_CHUNK_SIZE']))
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype=mimetype,
+        headers={'Content-Disposition': f'attachment; filename=receipts.{extension}'},
+    )
+
+def parse_date_range_args() -> Tuple[Optional[datetime], Optional[datetime]]:
+    """Read the optional start_date/end_date (YYYY-MM-DD) query arguments."""
+    start_date = request.args.get('start_date')
+    end_date = request.args.get('end_date')
+    return (
+        datetime.strptime(start_date, '%Y-%m-%d') if start_date else None,
+        datetime.strptime(end_date, '%Y-%m-%d') if end_date else None,
+    )
+
+def filter_receipt_dates(query, start_date: Optional[datetime], end_date: Optional[datetime]):
+    if start_date:
+        query = query.filter(Receipt.date >= start_date)
+    if end_date:
+        query = query.filter(Receipt.date <= end_date)
+    return query
+
+@app.route('/merchants/spend', methods=['GET'])
+@jwt_required()
+@cached_response
+def get_merchant_spend():
+    """Total spend per merchant, largest first."""
+    user_id = get_jwt_identity()
+    try:
+        start_date, end_date = parse_date_range_args()
+    except ValueError:
+        return jsonify({'message': 'Invalid date format, use YYYY-MM-DD'}), 400
+    limit = parse_limit_arg()
+
+    shard = router.shard_for(user_id)
+    session = shard.session()
+    total = func.sum(Receipt.total)
+    query = session.query(Receipt.merchant_id, total, func.count(Receipt.id)).filter(Receipt.user_id == user_id)
+    rows = filter_receipt_dates(query, start_date, end_date).group_by(
+        Receipt.merchant_id
+    ).order_by(total.desc()).limit(limit).all()
+
+    names = shard.merchants.names(session, (merchant_id for merchant_id, _, _ in rows))
+    return jsonify([
+        {'merchant_id': merchant_id, 'merchant': names.get(merchant_id), 'total': spent, 'receipt_count': count}
+        for merchant_id, spent, count in rows
+    ]), 200
+
+@app.route('/items/spend', methods=['GET'])
+@jwt_required()
+@cached_response
+def get_item_spend():
+    """Total spend per item name, largest first."""
+    user_id = get_jwt_identity()
+    try:
+        start_date, end_date = parse_date_range_args()
+    except ValueError:
+        return jsonify({'message': 'Invalid date format, use YYYY-MM-DD'}), 400
+    limit = parse_limit_arg()
+
+    shard = router.shard_for(user_id)
+    session = shard.session()
+    total = func.sum(Item.price)
+    query = session.query(Item.name_id, total, func.count(Item.id)).join(
+        Receipt, Receipt.id == Item.receipt_id
+    ).filter(Receipt.user_id == user_id)
+    rows = filter_receipt_dates(query, start_date, end_date).group_by(
+        Item.name_id
+    ).order_by(total.desc()).limit(limit).all()
+
+    names = shard.item_names.names(session, (name_id for name_id, _, _ in rows))
+    return jsonify([
+        {'item_id': name_id, 'name': names.get(name_id), 'total': spent, 'purchase_count': count}
+        for name_id, spent, count in rows
+    ]), 200
+
+@app.route('/items/<int:item_id>/prices', methods=['GET'])
+@jwt_required()
+@cached_response
+def get_item_price_history(item_id):
+    """Prices paid for one item name, most recent first."""
+    user_id = get_jwt_identity()
+    try:
+        start_date, end_date = parse_date_range_args()
+    except ValueError:
+        return jsonify({'message': 'Invalid date format, use YYYY-MM-DD'}), 400
+    limit = parse_limit_arg()
+
+    shard = router.shard_for(user_id)
+    session = shard.session()
+    query = session.query(Receipt.id, Receipt.date, Receipt.merchant_id, Item.quantity, Item.price).join(
+        Receipt, Receipt.id == Item.receipt_id
+    ).filter(Item.name_id == item_id, Receipt.user_id == user_id)
+    rows = filter_receipt_dates(query, start_date, end_date).order_by(
+        Receipt.date.desc(), Receipt.id.desc()
+    ).limit(limit).all()
+
+    # Item names are shared by all users on a shard; only reveal one the
+    # caller has bought themselves.
+    if not rows and not session.query(query.with_entities(Item.id).exists()).scalar():
+        return jsonify({'error': 'Item not found'}), 404
+    name = shard.item_names.names(session, [item_id]).get(item_id)
+
+    merchants = shard.merchants.names(session, (row.merchant_id for row in rows))
+    return jsonify({
+        'item_id': item_id,
+        'name': name,
+        'prices': [
+            {
+                'receipt_id': row.id,
+                'date': row.date.isoformat(),
+                'merchant': merchants.get(row.merchant_id),
+                'quantity': row.quantity,
+                'price': row.price,
+            }
+            for row in rows
+        ],
+    }), 200
+
+def summarize_expenses(user_id: int, start_date: datetime, end_date: datetime) -> Dict[str, float]:
+    """Sum a user's spending per category between two dates (inclusive)."""
+    session = router.session(user_id)
+    rows = session.query(ExpenseRollup.category, func.sum(ExpenseRollup.total)).filter(
+        ExpenseRollup.user_id == user_id,
+        ExpenseRollup.day >= start_date.date(),
+        ExpenseRollup.day <= end_date.date()
+    ).group_by(ExpenseRollup.category).all()
+
+    return {category: total for category, total in rows}
 
 @app.route('/expenses', methods=['GET'])
 @jwt_required()
+@cached_response
 def get_expenses():
     user_id = get_jwt_identity()
     start_date = request.args.get('start_date')
@@ -278,24 +2024,13 @@ def get_expenses():
     except ValueError:
         return jsonify({'message': 'Invalid date format, use YYYY-MM-DD'}), 400
 
-    session = Session(bind=engine)
-    expenses = session.query(Receipt).filter(
-        Receipt.user_id == user_id,
-        Receipt.date >= start_date,
-        Receipt.date <= end_date
-    ).all()
-    session.close()
-
-    # Summarize expenses by category
-    summary = {}
-    for receipt in expenses:
-        category = receipt.category
-        summary[category] = summary.get(category, 0) + receipt.total
+    summary = summarize_expenses(user_id, start_date, end_date)
 
     return jsonify(summary)
 
 @app.route('/charts/expenses', methods=['GET'])
 @jwt_required()
+@cached_response
 def get_expense_chart_data():
     user_id = get_jwt_identity()
     start_date = request.args.get('start_date')
@@ -308,19 +2043,7 @@ def get_expense_chart_data():
     except ValueError:
         return jsonify({'message': 'Invalid date format, use YYYY-MM-DD'}), 400
 
-    session = Session(bind=engine)
-    expenses = session.query(Receipt).filter(
-        Receipt.user_id == user_id,
-        Receipt.date >= start_date,
-        Receipt.date <= end_date
-    ).all()
-    session.close()
-
-    # Prepare data for chart
-    chart_data = {}
-    for receipt in expenses:
-        category = receipt.category
-        chart_data[category] = chart_data.get(category, 0) + receipt.total
+    chart_data = summarize_expenses(user_id, start_date, end_date)
 
     # Format data for chart rendering
     categories = list(chart_data.keys())
@@ -328,5 +2051,75 @@ def get_expense_chart_data():
 
     return jsonify({'categories': categories, 'values': values})
 
-if __name__ == '__main__':                                                                                                                                                              │
+@app.route('/cache/stats', methods=['GET'])
+def get_cache_stats():
+    return jsonify(response_cache.stats())
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    return Response(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+@app.cli.command('export-receipts')
+@click.argument('user_id', type=int)
+@click.option('--format', 'export_format', type=click.Choice(list(EXPORT_FORMATS)), default='csv')
+@click.option('--output', type=click.File('wb'), default='-', help='File to write (default stdout).')
+def export_receipts_command(user_id, export_format, output):
+    """Export all receipts and items of USER_ID."""
+    if export_format == 'arrow' and pa is None:
+        raise click.ClickException('Arrow export requires pyarrow')
+
+    writer = EXPORT_FORMATS[export_format][2]
+    for chunk in writer(iter_export_rows(router.session(user_id), user_id, app.config['EXPORT_CHUNK_SIZE'])):
+        output.write(chunk)
+
+@app.cli.command('rebuild-search-index')
+def rebuild_search_index_command():
+    """Re-index all stored receipts for full-text search."""
+    for shard in router.shards:
+        if not shard.search_enabled:
+            print(f'Shard {shard.index}: full-text search is not available in this SQLite build')
+            continue
+        session = shard.session()
+        rebuild_search_index(session)
+        session.commit()
+        print(f'Shard {shard.index}: search index rebuilt')
+
+@app.cli.command('rebuild-rollups')
+def rebuild_rollups_command():
+    """Recompute the expense rollup table from all stored receipts."""
+    for shard in router.shards:
+        session = shard.session()
+        rebuild_expense_rollups(session)
+        session.commit()
+        print(f'Shard {shard.index}: expense rollups rebuilt')
+
+@app.cli.command('move-user')
+@click.argument('user_id', type=int)
+@click.argument('shard', type=int)
+def move_user_command(user_id, shard):
+    """Move the receipts of USER_ID to SHARD (an index into SHARD_URLS)."""
+    if not 0 <= shard < len(router.shards):
+        raise click.ClickException(f'Shard must be between 0 and {len(router.shards) - 1}')
+    moved = move_user(user_id, shard, app.config['BATCH_CHUNK_SIZE'])
+    print(f'Moved {moved} receipts of user {user_id} to shard {shard}')
+
+@app.cli.command('rebalance-shards')
+@click.option('--dry-run', is_flag=True, help='Only list the users that would move.')
+def rebalance_shards_command(dry_run):
+    """Move every user to their home shard, e.g. after adding SHARD_URLS."""
+    session = db_session()
+    placements = session.query(UserShard.user_id, UserShard.shard).order_by(UserShard.user_id).all()
+    session.close()
+    moves = [(user_id, current, router.home_shard(user_id)) for user_id, current in placements
+             if current != router.home_shard(user_id)]
+    if dry_run:
+        for user_id, current, home in moves:
+            print(f'User {user_id}: shard {current} -> {home}')
+        return
+
+    moved = move_users([(user_id, home) for user_id, _, home in moves], app.config['BATCH_CHUNK_SIZE'])
+    for (user_id, current, home), count in zip(moves, moved):
+        print(f'User {user_id}: moved {count} receipts from shard {current} to {home}')
+
+if __name__ == '__main__':
     app.run(debug=True)
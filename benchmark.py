@@ -0,0 +1,314 @@
+"""Offline benchmarks for the receipt tracker API hot paths.
+
+Seeds a temporary SQLite database with synthetic users, receipts and items,
+then drives each endpoint through the Flask test client and reports
+throughput, latency percentiles, queries per request and peak memory.
+
+Usage:
+    python benchmark.py --receipts 1000
+    python benchmark.py --receipts 100000 --output after.json --compare before.json
+    python benchmark.py --receipts 100000 --shards 4
+"""
+import os
+import sys
+import json
+import random
+import argparse
+import platform
+import tempfile
+import tracemalloc
+from datetime import date, datetime, timedelta
+from time import perf_counter
+from typing import Callable, Dict, List
+
+MERCHANTS = [f'Merchant {i}' for i in range(200)]
+CATEGORIES = ['Groceries', 'Dining', 'Transport', 'Utilities', 'Health', 'Travel', 'Shopping', 'Entertainment']
+ITEM_NAMES = [f'Product {i}' for i in range(500)]
+FIRST_DAY = date(2022, 1, 1)
+DAYS = 3 * 365
+SEED_CHUNK_SIZE = 10000
+
+def parse_args(argv: List[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--receipts', type=int, default=1000, help='receipts to seed (default 1000)')
+    parser.add_argument('--users', type=int, default=10, help='users to spread receipts over (default 10)')
+    parser.add_argument('--max-items', type=int, default=5, help='maximum items per receipt (default 5)')
+    parser.add_argument('--requests', type=int, default=200, help='timed requests per endpoint (default 200)')
+    parser.add_argument('--memory-requests', type=int, default=20,
+                        help='requests per endpoint traced for peak memory (default 20)')
+    parser.add_argument('--shards', type=int, default=0,
+                        help='shard databases to add besides the main one (default 0, no sharding)')
+    parser.add_argument('--cache', action='store_true', help='leave the response cache enabled')
+    parser.add_argument('--seed', type=int, default=0, help='random seed (default 0)')
+    parser.add_argument('--output', help='write results to this JSON file')
+    parser.add_argument('--compare', help='compare against a previous JSON results file')
+    return parser.parse_args(argv)
+
+def seed_database(app_module, rng: random.Random, receipts: int, users: int, max_items: int) -> None:
+    """Bulk-load synthetic data straight through the engine.
+
+    Receipt n belongs to user (n - 1) % users + 1, so the benchmark can pick
+    a user's receipts without querying for them. Receipt ids are unique
+    across shards and each receipt is written to its user's home shard.
+    """
+    router = app_module.router
+    receipts_table = app_module.Receipt.__table__
+    items_table = app_module.Item.__table__
+
+    with app_module.engine.begin() as conn:
+        conn.execute(app_module.User.__table__.insert(), [
+            {'id': user_id, 'username': f'bench-user-{user_id}', 'password': 'bench'}
+            for user_id in range(1, users + 1)
+        ])
+        conn.execute(app_module.UserShard.__table__.insert(), [
+            {'user_id': user_id, 'shard': router.home_shard(user_id)} for user_id in range(1, users + 1)
+        ])
+    for shard in router.shards:
+        with shard.engine.begin() as conn:
+            conn.execute(app_module.Merchant.__table__.insert(), [
+                {'id': merchant_id, 'name': name} for merchant_id, name in enumerate(MERCHANTS, 1)
+            ])
+            conn.execute(app_module.ItemName.__table__.insert(), [
+                {'id': name_id, 'name': name} for name_id, name in enumerate(ITEM_NAMES, 1)
+            ])
+
+    item_id = 1
+    for start in range(1, receipts + 1, SEED_CHUNK_SIZE):
+        receipt_rows = {shard.index: [] for shard in router.shards}
+        item_rows = {shard.index: [] for shard in router.shards}
+        for receipt_id in range(start, min(start + SEED_CHUNK_SIZE, receipts + 1)):
+            user_id = (receipt_id - 1) % users + 1
+            shard_index = router.home_shard(user_id)
+            prices = [round(rng.uniform(0.5, 50.0), 2) for _ in range(rng.randint(1, max_items))]
+            receipt_rows[shard_index].append({
+                'id': receipt_id,
+                'user_id': user_id,
+                'merchant_id': rng.randint(1, len(MERCHANTS)),
+                'date': datetime.combine(FIRST_DAY + timedelta(days=rng.randrange(DAYS)), datetime.min.time()),
+                'total': round(sum(prices), 2),
+                'category': rng.choice(CATEGORIES),
+            })
+            for price in prices:
+                item_rows[shard_index].append({
+                    'id': item_id,
+                    'receipt_id': receipt_id,
+                    'name_id': rng.randint(1, len(ITEM_NAMES)),
+                    'quantity': str(rng.randint(1, 3)),
+                    'price': price,
+                })
+                item_id += 1
+
+        for shard in router.shards:
+            if not receipt_rows[shard.index]:
+                continue
+            with shard.engine.begin() as conn:
+                conn.execute(receipts_table.insert(), receipt_rows[shard.index])
+                conn.execute(items_table.insert(), item_rows[shard.index])
+
+    for shard in router.shards:
+        session = shard.session()
+        app_module.rebuild_expense_rollups(session)
+        if shard.search_enabled:
+            app_module.rebuild_search_index(session)
+        session.commit()
+    router.remove_sessions()
+
+def random_receipt(rng: random.Random, max_items: int) -> Dict:
+    items = [
+        {'name': rng.choice(ITEM_NAMES), 'quantity': '1', 'price': round(rng.uniform(0.5, 50.0), 2)}
+        for _ in range(rng.randint(1, max_items))
+    ]
+    return {
+        'merchant': rng.choice(MERCHANTS),
+        'date': (FIRST_DAY + timedelta(days=rng.randrange(DAYS))).isoformat(),
+        'total': round(sum(item['price'] for item in items), 2),
+        'category': rng.choice(CATEGORIES),
+        'items': items,
+    }
+
+def random_window(rng: random.Random) -> str:
+    start = FIRST_DAY + timedelta(days=rng.randrange(DAYS - 90))
+    end = start + timedelta(days=rng.choice((7, 30, 90)))
+    return f'start_date={start.isoformat()}&end_date={end.isoformat()}'
+
+def build_scenarios(client, tokens: Dict[int, str], rng: random.Random, args) -> Dict[str, Callable]:
+    """Map endpoint name to a callable issuing one request for a random user."""
+    users = args.users
+
+    def headers(user_id: int) -> Dict[str, str]:
+        return {'Authorization': f'Bearer {tokens[user_id]}'}
+
+    def random_user() -> int:
+        return rng.randint(1, users)
+
+    def upload_receipt():
+        return client.post('/receipts', json=random_receipt(rng, args.max_items), headers=headers(random_user()))
+
+    def get_receipt():
+        receipt_id = rng.randint(1, args.receipts)
+        return client.get(f'/receipts/{receipt_id}', headers=headers((receipt_id - 1) % users + 1))
+
+    def get_receipts():
+        return client.get('/receipts?limit=100&include_items=1', headers=headers(random_user()))
+
+    def get_expenses():
+        return client.get(f'/expenses?{random_window(rng)}', headers=headers(random_user()))
+
+    def get_expense_chart_data():
+        return client.get(f'/charts/expenses?{random_window(rng)}', headers=headers(random_user()))
+
+    def get_merchant_spend():
+        return client.get(f'/merchants/spend?{random_window(rng)}', headers=headers(random_user()))
+
+    def get_item_price_history():
+        item_id = rng.randint(1, len(ITEM_NAMES))
+        return client.get(f'/items/{item_id}/prices', headers=headers(random_user()))
+
+    def search_receipts():
+        query = f'{rng.choice(ITEM_NAMES).split()[0]} {rng.randrange(50)}'
+        return client.get(f'/receipts/search?q={query}&limit=20', headers=headers(random_user()))
+
+    return {
+        'upload_receipt': upload_receipt,
+        'get_receipt': get_receipt,
+        'get_receipts': get_receipts,
+        'get_expenses': get_expenses,
+        'get_expense_chart_data': get_expense_chart_data,
+        'search_receipts': search_receipts,
+        'get_merchant_spend': get_merchant_spend,
+        'get_item_price_history': get_item_price_history,
+    }
+
+def percentile(sorted_values: List[float], pct: float) -> float:
+    index = max(0, min(len(sorted_values) - 1, int(round(pct / 100 * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+def run_scenario(scenario: Callable, query_counter: List[int], requests: int, memory_requests: int) -> Dict:
+    latencies = []
+    errors = 0
+    query_counter[0] = 0
+
+    started = perf_counter()
+    for _ in range(requests):
+        request_started = perf_counter()
+        response = scenario()
+        response.get_data()
+        latencies.append(perf_counter() - request_started)
+        if response.status_code >= 400:
+            errors += 1
+        response.close()
+    elapsed = perf_counter() - started
+    queries = query_counter[0]
+
+    # Traced separately since tracemalloc would skew the latencies above.
+    tracemalloc.start()
+    for _ in range(memory_requests):
+        response = scenario()
+        response.get_data()
+        response.close()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    latencies.sort()
+    return {
+        'requests': requests,
+        'errors': errors,
+        'throughput_rps': round(requests / elapsed, 2),
+        'p50_ms': round(percentile(latencies, 50) * 1000, 3),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 3),
+        'queries_per_request': round(queries / requests, 2),
+        'peak_memory_kb': round(peak / 1024, 1),
+    }
+
+def compare(previous: Dict, current: Dict) -> None:
+    metrics = ('throughput_rps', 'p50_ms', 'p95_ms', 'p99_ms', 'queries_per_request', 'peak_memory_kb')
+    print(f"\n{'endpoint':<24}{'metric':<22}{'before':>12}{'after':>12}{'change':>10}")
+    for endpoint, result in current['results'].items():
+        before = previous['results'].get(endpoint)
+        if not before:
+            continue
+        for metric in metrics:
+            old, new = before.get(metric), result.get(metric)
+            if old is None or new is None:
+                continue
+            change = f'{(new - old) / old * 100:+.1f}%' if old else 'n/a'
+            print(f'{endpoint:<24}{metric:<22}{old:>12}{new:>12}{change:>10}')
+
+def main(argv: List[str]) -> int:
+    args = parse_args(argv)
+    rng = random.Random(args.seed)
+
+    tmpdir = tempfile.TemporaryDirectory(prefix='receipts-bench-')
+    os.environ['RECEIPTS_DATABASE_URL'] = f"sqlite:///{os.path.join(tmpdir.name, 'bench.db')}"
+    if args.shards:
+        os.environ['RECEIPTS_SHARD_URLS'] = json.dumps([
+            f"sqlite:///{os.path.join(tmpdir.name, f'bench-shard-{index}.db')}" for index in range(1, args.shards + 1)
+        ])
+    if not args.cache:
+        os.environ['RECEIPTS_RESPONSE_CACHE_MAX_ENTRIES'] = '0'
+
+    import app as app_module
+    from flask_jwt_extended import create_access_token
+    from sqlalchemy import event
+
+    started = perf_counter()
+    seed_database(app_module, rng, args.receipts, args.users, args.max_items)
+    print(f'Seeded {args.receipts} receipts for {args.users} users on {len(app_module.router.shards)} shard(s) '
+          f'in {perf_counter() - started:.1f}s')
+
+    query_counter = [0]
+
+    def count_query(*_):
+        query_counter[0] += 1
+
+    engines = {app_module.engine} | {shard.engine for shard in app_module.router.shards}
+    for engine in engines:
+        event.listen(engine, 'before_cursor_execute', count_query)
+
+    with app_module.app.app_context():
+        tokens = {user_id: create_access_token(identity=str(user_id)) for user_id in range(1, args.users + 1)}
+
+    client = app_module.app.test_client()
+    scenarios = build_scenarios(client, tokens, rng, args)
+
+    results = {}
+    for name, scenario in scenarios.items():
+        results[name] = run_scenario(scenario, query_counter, args.requests, args.memory_requests)
+        result = results[name]
+        print(f"{name:<24}{result['throughput_rps']:>10} req/s  p50 {result['p50_ms']}ms  "
+              f"p95 {result['p95_ms']}ms  p99 {result['p99_ms']}ms  "
+              f"{result['queries_per_request']} queries/req  peak {result['peak_memory_kb']} KiB")
+
+    report = {
+        'meta': {
+            'timestamp': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'receipts': args.receipts,
+            'users': args.users,
+            'shards': args.shards,
+            'max_items': args.max_items,
+            'requests': args.requests,
+            'cache': args.cache,
+            'seed': args.seed,
+        },
+        'results': results,
+    }
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f'Results written to {args.output}')
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), report)
+
+    app_module.router.dispose()
+    app_module.db_session.remove()
+    app_module.engine.dispose()
+    tmpdir.cleanup()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,96 @@
+import os
+import sys
+import sqlite3
+import tempfile
+
+import pytest
+
+# app configures its database on import, so point it somewhere disposable first
+os.environ['RECEIPTS_DATABASE_URL'] = f"sqlite:///{os.path.join(tempfile.mkdtemp(prefix='receipts-tests-'), 'import.db')}"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as app_module  # noqa: E402
+
+BASELINE_SCHEMA = """
+CREATE TABLE users (
+    id INTEGER PRIMARY KEY,
+    username VARCHAR NOT NULL UNIQUE,
+    password VARCHAR NOT NULL
+);
+CREATE TABLE receipts (
+    id INTEGER PRIMARY KEY,
+    user_id INTEGER NOT NULL REFERENCES users (id),
+    merchant VARCHAR NOT NULL,
+    date DATETIME NOT NULL,
+    total FLOAT NOT NULL
+);
+CREATE TABLE items (
+    id INTEGER PRIMARY KEY,
+    receipt_id INTEGER NOT NULL REFERENCES receipts (id),
+    name VARCHAR NOT NULL,
+    quantity VARCHAR,
+    price FLOAT NOT NULL
+);
+INSERT INTO users VALUES (1, 'alice', 'secret');
+INSERT INTO receipts VALUES (1, 1, 'Corner Shop', '2024-01-15 00:00:00.000000', 3.5);
+INSERT INTO receipts VALUES (2, 1, 'Bakery', '2024-02-01 00:00:00.000000', 2.0);
+INSERT INTO items VALUES (1, 1, 'Milk', '1', 2.5);
+INSERT INTO items VALUES (2, 1, 'Bread', '1', 1.0);
+INSERT INTO items VALUES (3, 2, 'Bread', '2', 2.0);
+"""
+
+@pytest.fixture
+def baseline_database(tmp_path):
+    """Create a database with the original schema holding alice's receipts; returns its file name."""
+    conn = sqlite3.connect(tmp_path / 'baseline.db')
+    conn.executescript(BASELINE_SCHEMA)
+    conn.close()
+    return 'baseline.db'
+
+@pytest.fixture
+def configure(tmp_path, monkeypatch):
+    """Return a function pointing the app at fresh databases under tmp_path."""
+    monkeypatch.setattr(app_module, 'response_cache', app_module.ResponseCache(1000, 1 << 20, 60))
+    # Shard moves wait this long before deleting the source's rows
+    monkeypatch.setitem(app_module.app.config, 'SHARD_DIRECTORY_TTL', 0.05)
+
+    def configure(shards: int = 0, database: str = 'main.db') -> None:
+        app_module.configure_database(
+            f'sqlite:///{tmp_path / database}',
+            [f"sqlite:///{tmp_path / f'shard-{index}.db'}" for index in range(1, shards + 1)],
+        )
+
+    yield configure
+    app_module.router.remove_sessions()
+    app_module.db_session.remove()
+
+@pytest.fixture
+def client(configure):
+    configure()
+    return app_module.app.test_client()
+
+@pytest.fixture
+def login(configure):
+    """Return a function registering a user and returning (user_id, auth headers)."""
+    def login(client, username: str, register: bool = True):
+        if register:
+            assert client.post('/register', json={'username': username, 'password': 'secret'}).status_code == 201
+        response = client.post('/login', json={'username': username, 'password': 'secret'})
+        token = response.get_json()['access_token']
+        user_id = app_module.db_session().query(app_module.User.id).filter_by(username=username).scalar()
+        return user_id, {'Authorization': f'Bearer {token}'}
+
+    return login
+
+def make_receipt(merchant: str = 'Corner Shop', day: str = '2024-01-15', items=(('Milk', 2.5),)):
+    return {
+        'merchant': merchant,
+        'date': day,
+        'total': round(sum(price for _, price in items), 2),
+        'category': 'Groceries',
+        'items': [{'name': name, 'quantity': '1', 'price': price} for name, price in items],
+    }
+
+@pytest.fixture
+def receipt():
+    return make_receipt
@@ -0,0 +1,76 @@
+import json
+
+import app as app_module
+
+def receipt_ids(client, headers):
+    return sorted(receipt['id'] for receipt in client.get('/receipts', headers=headers).get_json()['receipts'])
+
+def test_batch_json_array(client, login, receipt):
+    _, headers = login(client, 'alice')
+    batch = [receipt(day='2024-01-01'), receipt(day='2024-01-02', items=(('Milk', 2.5), ('Bread', 1.0)))]
+
+    response = client.post('/receipts/batch', json=batch, headers=headers)
+    assert response.status_code == 201
+    body = response.get_json()
+    assert (body['inserted'], body['failed']) == (2, 0)
+    assert [result['index'] for result in body['results']] == [0, 1]
+
+    ids = [result['receipt_id'] for result in body['results']]
+    assert receipt_ids(client, headers) == sorted(ids)
+    items = client.get(f'/receipts/{ids[1]}', headers=headers).get_json()['items']
+    assert [item['name'] for item in items] == ['Milk', 'Bread']
+
+def test_batch_reports_per_record_errors(client, login, receipt):
+    _, headers = login(client, 'alice')
+    bad_date = dict(receipt(), date='15/01/2024')
+    bad_price = receipt()
+    bad_price['items'][0]['price'] = 'free'
+
+    response = client.post('/receipts/batch', json=[receipt(), bad_date, 'nope', bad_price], headers=headers)
+    assert response.status_code == 207
+    body = response.get_json()
+    assert (body['inserted'], body['failed']) == (1, 3)
+
+    results = body['results']
+    assert [result['index'] for result in results] == [0, 1, 2, 3]
+    assert 'receipt_id' in results[0]
+    assert results[1]['errors'] == {'date': 'Invalid date format'}
+    assert results[2]['error'] == 'Expected a JSON object'
+    assert set(results[3]['errors']) == {'items[0].price'}
+    assert len(receipt_ids(client, headers)) == 1
+
+def test_batch_ndjson(client, login, receipt):
+    _, headers = login(client, 'alice')
+    lines = [json.dumps(receipt(day='2024-01-01')), '', '{not json', '[1, 2]', json.dumps(receipt(day='2024-01-02'))]
+
+    response = client.post('/receipts/batch', data='\n'.join(lines) + '\n',
+                           headers={**headers, 'Content-Type': 'application/x-ndjson'})
+    assert response.status_code == 207
+    results = response.get_json()['results']
+    # Blank lines are skipped without using up an index
+    assert [(result['index'], result.get('error')) for result in results] == [
+        (0, None), (1, 'Invalid JSON'), (2, 'Expected a JSON object'), (3, None),
+    ]
+    assert len(receipt_ids(client, headers)) == 2
+
+def test_batch_is_saved_in_chunks(client, login, receipt, monkeypatch):
+    _, headers = login(client, 'alice')
+    monkeypatch.setitem(app_module.app.config, 'BATCH_CHUNK_SIZE', 2)
+    batch_sizes = []
+    save_receipt_batch = app_module.save_receipt_batch
+
+    def recording_save(records, user_id):
+        batch_sizes.append(len(records))
+        return save_receipt_batch(records, user_id)
+
+    monkeypatch.setattr(app_module, 'save_receipt_batch', recording_save)
+    response = client.post('/receipts/batch', json=[receipt() for _ in range(5)], headers=headers)
+    assert response.status_code == 201
+    assert batch_sizes == [2, 2, 1]
+    assert len(receipt_ids(client, headers)) == 5
+
+def test_batch_rejects_other_bodies(client, login):
+    _, headers = login(client, 'alice')
+    assert client.post('/receipts/batch', json={'merchant': 'x'}, headers=headers).status_code == 400
+    assert client.post('/receipts/batch', json=[], headers=headers).status_code == 400
+    assert client.post('/receipts/batch', json=[]).status_code == 401
@@ -0,0 +1,64 @@
+import app as app_module
+
+EXPENSES = '/expenses?start_date=2024-01-01&end_date=2024-12-31'
+
+def test_etag_and_not_modified(client, login, receipt):
+    _, headers = login(client, 'alice')
+    client.post('/receipts', json=receipt(), headers=headers)
+
+    first = client.get(EXPENSES, headers=headers)
+    assert first.status_code == 200
+    etag = first.headers['ETag']
+    assert first.headers['Cache-Control'] == 'private, no-cache'
+
+    again = client.get(EXPENSES, headers={**headers, 'If-None-Match': etag})
+    assert again.status_code == 304
+    assert again.get_data() == b''
+    assert app_module.response_cache.stats()['hits'] == 1
+
+def test_upload_invalidates_only_the_writer(client, login, receipt):
+    _, alice = login(client, 'alice')
+    _, bob = login(client, 'bob')
+    client.post('/receipts', json=receipt(), headers=alice)
+    client.post('/receipts', json=receipt(), headers=bob)
+    alice_etag = client.get(EXPENSES, headers=alice).headers['ETag']
+    bob_etag = client.get(EXPENSES, headers=bob).headers['ETag']
+
+    client.post('/receipts/batch', json=[receipt()], headers=alice)
+
+    response = client.get(EXPENSES, headers={**alice, 'If-None-Match': alice_etag})
+    assert response.status_code == 200
+    assert response.get_json() == {'Groceries': 5.0}
+    assert response.headers['ETag'] != alice_etag
+    assert client.get(EXPENSES, headers={**bob, 'If-None-Match': bob_etag}).status_code == 304
+
+def test_entries_are_per_query(client, login, receipt):
+    _, headers = login(client, 'alice')
+    client.post('/receipts', json=receipt(day='2024-03-01'), headers=headers)
+
+    assert client.get(EXPENSES, headers=headers).get_json() == {'Groceries': 2.5}
+    assert client.get('/expenses?start_date=2024-01-01&end_date=2024-01-31', headers=headers).get_json() == {}
+
+def test_errors_are_not_cached(client, login):
+    _, headers = login(client, 'alice')
+    assert client.get('/receipts/1', headers=headers).status_code == 404
+    assert app_module.response_cache.stats()['entries'] == 0
+
+def test_lru_and_ttl():
+    cache = app_module.ResponseCache(max_entries=2, max_bytes=1 << 20, ttl=60)
+    for key in ('a', 'b', 'c'):
+        cache.set((1, key), key.encode(), 'application/json', cache.generation(1))
+    assert cache.get((1, 'a')) is None
+    assert cache.get((1, 'c')).body == b'c'
+
+    expired = app_module.ResponseCache(max_entries=10, max_bytes=1 << 20, ttl=0)
+    expired.set((1, 'a'), b'a', 'application/json', expired.generation(1))
+    assert expired.get((1, 'a')) is None
+
+def test_stale_generation_is_not_stored():
+    cache = app_module.ResponseCache(max_entries=10, max_bytes=1 << 20, ttl=60)
+    generation = cache.generation(1)
+    # A write committed while the response was being rendered
+    cache.invalidate_user(1)
+    cache.set((1, 'a'), b'a', 'application/json', generation)
+    assert cache.get((1, 'a')) is None
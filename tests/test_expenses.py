@@ -0,0 +1,51 @@
+import app as app_module
+
+YEAR = 'start_date=2024-01-01&end_date=2024-12-31'
+
+def test_expenses_follow_uploads(client, login, receipt):
+    _, headers = login(client, 'alice')
+    client.post('/receipts', json=receipt(day='2024-01-15', items=(('Milk', 2.5),)), headers=headers)
+    client.post('/receipts', json=dict(receipt(day='2024-01-15', items=(('Taxi', 20.0),)), category='Transport'),
+                headers=headers)
+    client.post('/receipts/batch', json=[receipt(day='2024-03-01', items=(('Bread', 1.5),))] * 2, headers=headers)
+
+    assert client.get(f'/expenses?{YEAR}', headers=headers).get_json() == {'Groceries': 5.5, 'Transport': 20.0}
+    assert client.get('/expenses?start_date=2024-01-15&end_date=2024-01-15', headers=headers).get_json() == {
+        'Groceries': 2.5, 'Transport': 20.0,
+    }
+    chart = client.get(f'/charts/expenses?{YEAR}', headers=headers).get_json()
+    assert dict(zip(chart['categories'], chart['values'])) == {'Groceries': 5.5, 'Transport': 20.0}
+
+def test_expenses_are_per_user(client, login, receipt):
+    _, alice = login(client, 'alice')
+    _, bob = login(client, 'bob')
+    client.post('/receipts', json=receipt(), headers=alice)
+
+    assert client.get(f'/expenses?{YEAR}', headers=alice).get_json() == {'Groceries': 2.5}
+    assert client.get(f'/expenses?{YEAR}', headers=bob).get_json() == {}
+
+def test_expenses_validate_dates(client, login):
+    _, headers = login(client, 'alice')
+    assert client.get('/expenses?start_date=2024-01-01', headers=headers).status_code == 400
+    assert client.get('/expenses?start_date=2024-01-01&end_date=31.12.2024', headers=headers).status_code == 400
+
+def test_rollups_match_a_rebuild(client, login, receipt):
+    _, headers = login(client, 'alice')
+    for day in ('2024-01-01', '2024-01-01', '2024-02-10'):
+        client.post('/receipts', json=receipt(day=day), headers=headers)
+
+    table = app_module.ExpenseRollup.__table__
+    session = app_module.router.shards[0].session()
+    maintained = sorted(session.execute(table.select()).all())
+    app_module.rebuild_expense_rollups(session)
+    assert sorted(session.execute(table.select()).all()) == maintained
+    session.rollback()
+
+def test_baseline_database_gets_categories_and_rollups(baseline_database, configure, login):
+    configure(database=baseline_database)
+    client = app_module.app.test_client()
+    _, headers = login(client, 'alice', register=False)
+
+    receipt = client.get('/receipts/1', headers=headers).get_json()
+    assert receipt['category'] == app_module.DEFAULT_CATEGORY
+    assert client.get(f'/expenses?{YEAR}', headers=headers).get_json() == {app_module.DEFAULT_CATEGORY: 5.5}
@@ -0,0 +1,95 @@
+import csv
+import io
+import json
+
+import pytest
+
+import app as app_module
+
+def export(client, headers, export_format):
+    response = client.get(f'/receipts/export?format={export_format}', headers=headers)
+    assert response.status_code == 200
+    body = response.get_data()
+    response.close()
+    return response, body
+
+@pytest.fixture
+def history(client, login, receipt):
+    """Alice with a two-item receipt and an itemless one; bob with one receipt."""
+    user_id, headers = login(client, 'alice')
+    client.post('/receipts', json=receipt(items=(('Milk', 2.5), ('Bread', 1.0))), headers=headers)
+    client.post('/receipts', json={**receipt(merchant='Bakery', day='2024-02-01'), 'items': [], 'total': 4.0},
+                headers=headers)
+    _, bob = login(client, 'bob')
+    client.post('/receipts', json=receipt(merchant='Elsewhere'), headers=bob)
+    return user_id, headers
+
+EXPECTED = [
+    ['Corner Shop', '2024-01-15', 'Milk', 2.5],
+    ['Corner Shop', '2024-01-15', 'Bread', 1.0],
+    ['Bakery', '2024-02-01', None, None],
+]
+
+def test_csv(client, history):
+    _, headers = history
+    response, body = export(client, headers, 'csv')
+    assert response.mimetype == 'text/csv'
+    assert response.headers['Content-Disposition'] == 'attachment; filename=receipts.csv'
+
+    rows = list(csv.DictReader(io.StringIO(body.decode())))
+    assert list(rows[0]) == list(app_module.EXPORT_COLUMNS)
+    assert [[row['merchant'], row['date'], row['item_name'] or None, float(row['item_price']) if row['item_price'] else None]
+            for row in rows] == EXPECTED
+    assert rows[0]['category'] == 'Groceries'
+
+def test_ndjson(client, history):
+    _, headers = history
+    response, body = export(client, headers, 'ndjson')
+    assert response.mimetype == 'application/x-ndjson'
+
+    rows = [json.loads(line) for line in body.decode().splitlines()]
+    assert [[row['merchant'], row['date'], row['item_name'], row['item_price']] for row in rows] == EXPECTED
+    assert rows[2]['total'] == 4.0
+
+def test_arrow(client, history):
+    pa = pytest.importorskip('pyarrow')
+    _, headers = history
+    response, body = export(client, headers, 'arrow')
+    assert response.mimetype == 'application/vnd.apache.arrow.stream'
+
+    table = pa.ipc.open_stream(body).read_all()
+    assert table.column_names == list(app_module.EXPORT_COLUMNS)
+    rows = table.to_pylist()
+    assert [[row['merchant'], row['date'].isoformat(), row['item_name'], row['item_price']] for row in rows] == EXPECTED
+
+def test_arrow_writes_a_batch_per_chunk(client, history, monkeypatch):
+    pa = pytest.importorskip('pyarrow')
+    _, headers = history
+    monkeypatch.setitem(app_module.app.config, 'EXPORT_CHUNK_SIZE', 1)
+    _, body = export(client, headers, 'arrow')
+    reader = pa.ipc.open_stream(body)
+    assert [batch.num_rows for batch in reader] == [1, 1, 1]
+
+def test_empty_history(client, login):
+    _, headers = login(client, 'alice')
+    assert export(client, headers, 'csv')[1].decode().strip() == ','.join(app_module.EXPORT_COLUMNS)
+    assert export(client, headers, 'ndjson')[1] == b''
+
+def test_unsupported_format(client, login):
+    _, headers = login(client, 'alice')
+    response = client.get('/receipts/export?format=xlsx', headers=headers)
+    assert response.status_code == 400
+    assert response.get_json() == {'error': 'Unsupported format, use one of: csv, ndjson, arrow'}
+
+def test_cli_export(history, tmp_path):
+    user_id, _ = history
+    runner = app_module.app.test_cli_runner()
+
+    result = runner.invoke(args=['export-receipts', str(user_id), '--format', 'ndjson'])
+    assert result.exit_code == 0, result.output
+    assert [json.loads(line)['merchant'] for line in result.output.splitlines()] == ['Corner Shop', 'Corner Shop', 'Bakery']
+
+    output = tmp_path / 'receipts.csv'
+    result = runner.invoke(args=['export-receipts', str(user_id), '--output', str(output)])
+    assert result.exit_code == 0, result.output
+    assert len(list(csv.DictReader(output.open()))) == 3
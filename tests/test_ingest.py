@@ -0,0 +1,137 @@
+import time
+import queue
+
+import pytest
+from sqlalchemy.exc import OperationalError
+
+import app as app_module
+
+@pytest.fixture
+def ingest(client, monkeypatch):
+    ingest_queue = app_module.IngestQueue(workers=1, max_size=100, group_size=10, group_window=0.05, ticket_limit=100)
+    ingest_queue.start()
+    monkeypatch.setattr(app_module, 'ingest_queue', ingest_queue)
+    yield ingest_queue
+    ingest_queue.shutdown()
+
+class RecordingQueue(app_module.IngestQueue):
+    """Records the size of every group it commits."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.groups = []
+
+    def _commit_group(self, *args):
+        self.groups.append(len(args[-1]))
+        super()._commit_group(*args)
+
+def validated(data):
+    receipt, errors = app_module.receipt_validator.validate(data)
+    assert not errors
+    return receipt
+
+def wait_for(ingest_queue, ticket_ids, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while True:
+        statuses = [ingest_queue.status(ticket_id) for ticket_id in ticket_ids]
+        if all(status['status'] != 'pending' for status in statuses) or time.monotonic() > deadline:
+            return [status['status'] for status in statuses]
+        time.sleep(0.01)
+
+def test_async_upload(client, login, receipt, ingest):
+    user_id, headers = login(client, 'alice')
+    response = client.post('/receipts', json=receipt(), headers=headers)
+    assert response.status_code == 202
+    ticket_id = response.get_json()['ticket_id']
+
+    assert wait_for(ingest, [ticket_id]) == ['done']
+    ticket = client.get(f'/receipts/tickets/{ticket_id}', headers=headers).get_json()
+    assert ticket['status'] == 'done'
+    assert client.get(f"/receipts/{ticket['receipt_id']}", headers=headers).status_code == 200
+
+def test_invalid_receipts_are_rejected_before_queueing(client, login, ingest):
+    _, headers = login(client, 'alice')
+    response = client.post('/receipts', json={'merchant': 'Shop'}, headers=headers)
+    assert response.status_code == 400
+    assert ingest.depth() == 0
+
+def test_unknown_tickets(client, login, receipt, ingest):
+    _, alice = login(client, 'alice')
+    _, bob = login(client, 'bob')
+    ticket_id = client.post('/receipts', json=receipt(), headers=alice).get_json()['ticket_id']
+    wait_for(ingest, [ticket_id])
+
+    for headers, ticket in ((bob, ticket_id), (alice, 'f' * 32)):
+        response = client.get(f'/receipts/tickets/{ticket}', headers=headers)
+        assert response.status_code == 404
+        assert response.get_json()['status'] == 'unknown'
+
+def test_receipts_are_committed_in_groups(client, login, receipt):
+    user_id, headers = login(client, 'alice')
+    ingest_queue = RecordingQueue(workers=1, max_size=100, group_size=50, group_window=0.5, ticket_limit=100)
+
+    tickets = [ingest_queue.submit(user_id, validated(receipt()), timeout=1) for _ in range(20)]
+    ingest_queue.start()
+    assert wait_for(ingest_queue, tickets) == ['done'] * 20
+    ingest_queue.shutdown()
+
+    assert ingest_queue.groups == [20]
+    receipt_ids = {ingest_queue.status(ticket_id)['receipt_id'] for ticket_id in tickets}
+    assert len(receipt_ids) == 20
+    assert len(client.get('/receipts', headers=headers).get_json()['receipts']) == 20
+
+def test_full_queue_pushes_back(client, login, receipt, monkeypatch):
+    _, headers = login(client, 'alice')
+    ingest_queue = app_module.IngestQueue(workers=1, max_size=1, group_size=10, group_window=0.05, ticket_limit=100)
+    monkeypatch.setattr(app_module, 'ingest_queue', ingest_queue)
+    monkeypatch.setitem(app_module.app.config, 'INGEST_ENQUEUE_TIMEOUT', 0.01)
+
+    # Not started, so nothing drains the queue
+    assert client.post('/receipts', json=receipt(), headers=headers).status_code == 202
+    response = client.post('/receipts', json=receipt(), headers=headers)
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == '1'
+    ingest_queue.start()
+    ingest_queue.shutdown()
+
+def test_shard_lookup_failure_fails_only_its_ticket(client, login, receipt, ingest, monkeypatch):
+    user_id, headers = login(client, 'alice')
+    shard_for = app_module.router.shard_for
+    failures = [OperationalError('SELECT', {}, Exception('database is locked'))]
+
+    def flaky_shard_for(owner, fresh=False):
+        if failures:
+            raise failures.pop()
+        return shard_for(owner, fresh)
+
+    monkeypatch.setattr(app_module.router, 'shard_for', flaky_shard_for)
+    tickets = [ingest.submit(user_id, validated(receipt(day=day)), timeout=1) for day in ('2024-01-01', '2024-01-02')]
+    assert wait_for(ingest, tickets) == ['failed', 'done']
+
+    # The worker survived and keeps committing
+    assert wait_for(ingest, [ingest.submit(user_id, validated(receipt()), timeout=1)]) == ['done']
+
+def test_commit_failure_fails_tickets_and_keeps_worker(client, login, receipt, ingest, monkeypatch):
+    user_id, headers = login(client, 'alice')
+
+    def failing_insert(session, owner, records):
+        raise OperationalError('INSERT', {}, Exception('disk I/O error'))
+
+    with monkeypatch.context() as patch:
+        patch.setattr(app_module, 'insert_receipts', failing_insert)
+        tickets = [ingest.submit(user_id, validated(receipt()), timeout=1) for _ in range(3)]
+        assert wait_for(ingest, tickets) == ['failed'] * 3
+
+    assert wait_for(ingest, [ingest.submit(user_id, validated(receipt()), timeout=1)]) == ['done']
+    assert len(client.get('/receipts', headers=headers).get_json()['receipts']) == 1
+
+def test_shutdown_commits_queued_receipts_and_rejects_new_ones(client, login, receipt):
+    user_id, headers = login(client, 'alice')
+    ingest_queue = app_module.IngestQueue(workers=2, max_size=100, group_size=10, group_window=0.05, ticket_limit=100)
+    ingest_queue.start()
+    tickets = [ingest_queue.submit(user_id, validated(receipt()), timeout=1) for _ in range(20)]
+    ingest_queue.shutdown()
+
+    assert [ingest_queue.status(ticket_id)['status'] for ticket_id in tickets] == ['done'] * 20
+    with pytest.raises(queue.Full):
+        ingest_queue.submit(user_id, validated(receipt()), timeout=1)
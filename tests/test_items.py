@@ -0,0 +1,135 @@
+import threading
+
+import pytest
+import sqlalchemy as db
+
+import app as app_module
+
+@pytest.fixture
+def users(client, login, receipt):
+    """alice has bought a test kit and milk; bob has only bought bread."""
+    alice = login(client, 'alice')[1]
+    bob = login(client, 'bob')[1]
+    kit = receipt(merchant='Pharmacy', items=(('Test kit', 12.0), ('Milk', 2.5)))
+    assert client.post('/receipts', json=kit, headers=alice).status_code == 201
+    assert client.post('/receipts', json=receipt(merchant='Bakery', items=(('Bread', 1.5),)), headers=bob).status_code == 201
+    return alice, bob
+
+def item_ids(client, headers):
+    return {item['name']: item['item_id'] for item in client.get('/items/spend', headers=headers).get_json()}
+
+def test_item_spend_only_counts_own_receipts(client, users):
+    alice, bob = users
+    assert set(item_ids(client, alice)) == {'Test kit', 'Milk'}
+    assert set(item_ids(client, bob)) == {'Bread'}
+
+def test_merchant_spend_only_counts_own_receipts(client, users):
+    alice, bob = users
+    assert [row['merchant'] for row in client.get('/merchants/spend', headers=alice).get_json()] == ['Pharmacy']
+    assert [row['merchant'] for row in client.get('/merchants/spend', headers=bob).get_json()] == ['Bakery']
+
+def test_price_history_of_own_item(client, users):
+    alice, _ = users
+    kit_id = item_ids(client, alice)['Test kit']
+
+    response = client.get(f'/items/{kit_id}/prices', headers=alice)
+    assert response.status_code == 200
+    assert response.get_json()['name'] == 'Test kit'
+    assert [price['price'] for price in response.get_json()['prices']] == [12.0]
+
+    # Outside the date range the item is still the caller's
+    response = client.get(f'/items/{kit_id}/prices?start_date=2030-01-01', headers=alice)
+    assert response.status_code == 200
+    assert response.get_json() == {'item_id': kit_id, 'name': 'Test kit', 'prices': []}
+
+def test_price_history_hides_other_users_items(client, users):
+    alice, bob = users
+    kit_id = item_ids(client, alice)['Test kit']
+
+    for query in ('', '?start_date=2024-01-01&end_date=2024-12-31'):
+        response = client.get(f'/items/{kit_id}/prices{query}', headers=bob)
+        assert response.status_code == 404
+        assert 'Test kit' not in response.get_data(as_text=True)
+    # Indistinguishable from an id that does not exist
+    assert client.get('/items/9999/prices', headers=bob).get_json() == response.get_json()
+
+def test_receipt_of_other_user_is_not_found(client, users):
+    alice, bob = users
+    receipt_id = client.get('/receipts', headers=alice).get_json()['receipts'][0]['id']
+    assert client.get(f'/receipts/{receipt_id}', headers=alice).status_code == 200
+    assert client.get(f'/receipts/{receipt_id}', headers=bob).status_code == 404
+
+def test_baseline_names_are_interned(baseline_database, configure, login):
+    configure(database=baseline_database)
+    inspector = db.inspect(app_module.engine)
+    receipt_columns = {column['name'] for column in inspector.get_columns('receipts')}
+    item_columns = {column['name'] for column in inspector.get_columns('items')}
+    assert 'merchant_id' in receipt_columns and 'merchant' not in receipt_columns
+    assert 'name_id' in item_columns and 'name' not in item_columns
+
+    # Running the migration again leaves the interned data alone
+    configure(database=baseline_database)
+    client = app_module.app.test_client()
+    _, headers = login(client, 'alice', register=False)
+    receipt = client.get('/receipts/1', headers=headers).get_json()
+    assert receipt['merchant'] == 'Corner Shop'
+    assert [item['name'] for item in receipt['items']] == ['Milk', 'Bread']
+    assert set(item_ids(client, headers)) == {'Milk', 'Bread'}
+
+def test_concurrent_migrations_run_one_at_a_time(baseline_database, tmp_path, monkeypatch):
+    url = f'sqlite:///{tmp_path / baseline_database}'
+    started, release = threading.Event(), threading.Event()
+    interned = []
+    intern = app_module.intern_legacy_column
+
+    def slow_intern(conn, table, *args):
+        interned.append((threading.current_thread().name, table))
+        started.set()
+        release.wait(5)
+        intern(conn, table, *args)
+
+    monkeypatch.setattr(app_module, 'intern_legacy_column', slow_intern)
+    errors = []
+
+    def migrate():
+        engine = app_module.create_db_engine(url)
+        try:
+            app_module.migrate_schema(engine)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            engine.dispose()
+
+    first = threading.Thread(target=migrate, name='first')
+    first.start()
+    assert started.wait(5)
+    second = threading.Thread(target=migrate, name='second')
+    second.start()
+    # The second worker waits for the lock instead of inspecting a half-migrated schema
+    second.join(0.2)
+    assert second.is_alive()
+
+    release.set()
+    first.join()
+    second.join()
+    assert errors == []
+    assert interned == [('first', 'receipts'), ('first', 'items')]
+
+    engine = app_module.create_db_engine(url)
+    with engine.connect() as conn:
+        assert conn.execute(db.text('SELECT sum(total), sum(receipt_count) FROM expense_rollups')).one() == (5.5, 2)
+    engine.dispose()
+
+def test_name_cache_is_bounded(client, login, receipt):
+    _, headers = login(client, 'alice')
+    shard = app_module.router.shards[0]
+    shard.item_names.cache_size = 3
+    for day in range(1, 6):
+        items = ((f'Item {day}a', 1.0), (f'Item {day}b', 1.0))
+        assert client.post('/receipts', json=receipt(day=f'2024-01-{day:02}', items=items), headers=headers).status_code == 201
+        assert len(shard.item_names._ids) <= 3
+        assert len(shard.item_names._names) <= 3
+
+    # Evicted names resolve from the database again
+    names = [item['name'] for item in client.get('/receipts/1', headers=headers).get_json()['items']]
+    assert names == ['Item 1a', 'Item 1b']
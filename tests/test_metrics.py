@@ -0,0 +1,64 @@
+import pytest
+import sqlalchemy as db
+
+import app as app_module
+
+@pytest.fixture
+def metrics(monkeypatch):
+    fresh = app_module.Metrics(slow_query_threshold=0.2)
+    monkeypatch.setattr(app_module, 'metrics', fresh)
+    return fresh
+
+def samples(client):
+    """Parse /metrics into {'name{labels}': value}, skipping comments."""
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    assert response.content_type.startswith('text/plain; version=0.0.4')
+    result = {}
+    for line in response.get_data(as_text=True).splitlines():
+        if line and not line.startswith('#'):
+            name, value = line.rsplit(' ', 1)
+            result[name] = float(value)
+    return result
+
+def test_counts_requests_and_their_queries(client, login, receipt, metrics):
+    _, headers = login(client, 'alice')
+    client.post('/receipts', json=receipt(), headers=headers)
+    client.get('/receipts/999', headers=headers)
+
+    values = samples(client)
+    assert values['receipts_http_requests_total{endpoint="upload_receipt",method="POST",status="201"}'] == 1
+    assert values['receipts_http_requests_total{endpoint="get_receipt",method="GET",status="404"}'] == 1
+    assert values['receipts_http_request_duration_seconds_count{endpoint="upload_receipt",method="POST"}'] == 1
+    assert values['receipts_http_request_queries_sum{endpoint="upload_receipt",method="POST"}'] > 0
+    assert values['receipts_db_query_duration_seconds_count'] > 0
+    assert values['receipts_db_transactions_total{outcome="commit"}'] >= 2
+    assert values['receipts_db_pool_size{database="main"}'] == app_module.app.config['DATABASE_POOL_SIZE']
+    assert 'receipts_response_cache_hits_total' in values
+
+def test_streamed_responses_are_measured_when_closed(client, login, receipt, metrics):
+    _, headers = login(client, 'alice')
+    client.post('/receipts', json=receipt(), headers=headers)
+
+    for path in ('/receipts?include_items=1', '/receipts/export?format=ndjson'):
+        response = client.get(path, headers=headers)
+        response.get_data()
+        response.close()
+
+    values = samples(client)
+    # Listing with items runs the page query and the item load
+    assert values['receipts_http_request_queries_sum{endpoint="get_receipts",method="GET"}'] >= 2
+    assert values['receipts_http_request_queries_sum{endpoint="export_receipts",method="GET"}'] >= 1
+
+def test_slow_queries_are_counted(client, metrics):
+    metrics.slow_query_threshold = 0
+    with app_module.engine.connect() as conn:
+        conn.execute(db.text('SELECT 1'))
+    assert metrics.slow_queries >= 1
+
+def test_failed_statements_do_not_leak_timers(client):
+    with app_module.engine.connect() as conn:
+        for _ in range(5):
+            with pytest.raises(db.exc.OperationalError):
+                conn.execute(db.text('SELECT * FROM missing_table'))
+        assert conn.info.get('query_start_time', []) == []
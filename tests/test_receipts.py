@@ -0,0 +1,67 @@
+import base64
+
+def page(client, headers, query=''):
+    response = client.get(f'/receipts{query}', headers=headers)
+    return response.status_code, response.get_json()
+
+def test_pages_cover_every_receipt_once(client, login, receipt):
+    _, headers = login(client, 'alice')
+    # Same-day receipts make the id the tie breaker
+    days = ['2024-01-03', '2024-01-01', '2024-01-02', '2024-01-02', '2024-01-02', '2024-01-04', '2024-01-01']
+    client.post('/receipts/batch', json=[receipt(day=day) for day in days], headers=headers)
+
+    seen = []
+    status, body = page(client, headers, '?limit=3')
+    while True:
+        assert status == 200
+        seen.extend((receipt['date'], receipt['id']) for receipt in body['receipts'])
+        if body['next_cursor'] is None:
+            break
+        status, body = page(client, headers, f"?limit=3&cursor={body['next_cursor']}")
+
+    assert len(seen) == len(days)
+    assert seen == sorted(seen, reverse=True)
+
+def test_last_page_has_no_cursor(client, login, receipt):
+    _, headers = login(client, 'alice')
+    client.post('/receipts/batch', json=[receipt() for _ in range(4)], headers=headers)
+
+    _, body = page(client, headers, '?limit=2')
+    _, body = page(client, headers, f"?limit=2&cursor={body['next_cursor']}")
+    assert len(body['receipts']) == 2
+    assert body['next_cursor'] is None
+
+    _, body = page(client, headers, '?limit=4')
+    assert body['next_cursor'] is None
+
+def test_empty_list(client, login):
+    _, headers = login(client, 'alice')
+    assert page(client, headers) == (200, {'receipts': [], 'next_cursor': None})
+
+def test_invalid_cursor(client, login):
+    _, headers = login(client, 'alice')
+    for cursor in ('garbage', base64.urlsafe_b64encode(b'2024-01-01|x').decode(),
+                   base64.urlsafe_b64encode(b'not a date|3').decode()):
+        status, body = page(client, headers, f'?cursor={cursor}')
+        assert status == 400
+        assert body == {'error': 'Invalid cursor'}
+
+def test_include_items_and_limit_bounds(client, login, receipt):
+    _, headers = login(client, 'alice')
+    client.post('/receipts', json=receipt(items=(('Milk', 2.5), ('Bread', 1.0))), headers=headers)
+
+    _, body = page(client, headers)
+    assert 'items' not in body['receipts'][0]
+    _, body = page(client, headers, '?include_items=1')
+    assert [item['name'] for item in body['receipts'][0]['items']] == ['Milk', 'Bread']
+
+    client.post('/receipts', json=receipt(), headers=headers)
+    _, body = page(client, headers, '?limit=0')
+    assert len(body['receipts']) == 1
+
+def test_lists_only_own_receipts(client, login, receipt):
+    _, alice = login(client, 'alice')
+    _, bob = login(client, 'bob')
+    client.post('/receipts', json=receipt(), headers=alice)
+    assert len(page(client, alice)[1]['receipts']) == 1
+    assert page(client, bob)[1]['receipts'] == []
@@ -0,0 +1,49 @@
+import pytest
+
+import app as app_module
+
+@pytest.fixture
+def search(client, login, receipt):
+    """alice and bob each have receipts; returns a function searching as alice or bob."""
+    if not app_module.router.shards[0].search_enabled:
+        pytest.skip('SQLite was built without FTS5')
+
+    users = {name: login(client, name)[1] for name in ('alice', 'bob')}
+    client.post('/receipts/batch', json=[
+        receipt(merchant='Blue Bottle Coffee', day='2024-01-10', items=(('Latte', 4.5),)),
+        receipt(merchant='Corner Shop', day='2024-02-10', items=(('Coffee beans', 12.0), ('Milk', 1.5))),
+        receipt(merchant='Hardware Store', day='2024-03-10', items=(('Hammer', 20.0),)),
+    ], headers=users['alice'])
+    client.post('/receipts', json=receipt(merchant='Coffee Corner', items=(('Espresso', 3.0),)), headers=users['bob'])
+
+    def search(username, query):
+        response = client.get(f'/receipts/search?{query}', headers=users[username])
+        assert response.status_code == 200
+        return [result['merchant'] for result in response.get_json()['results']]
+
+    return search
+
+def test_matches_merchants_and_items_by_prefix(search):
+    assert search('alice', 'q=hamm') == ['Hardware Store']
+    assert search('alice', 'q=bottle cof') == ['Blue Bottle Coffee']
+
+def test_ranks_merchant_matches_first(search):
+    assert search('alice', 'q=coffee') == ['Blue Bottle Coffee', 'Corner Shop']
+
+def test_only_searches_own_receipts(search):
+    assert search('bob', 'q=coffee') == ['Coffee Corner']
+    assert search('bob', 'q=hammer') == []
+
+def test_owner_tokens_are_not_searchable(search):
+    assert search('alice', 'q=u') == []
+    assert search('alice', 'q=u1') == []
+    assert search('bob', 'q=u2') == []
+
+def test_date_range_and_paging(search):
+    assert search('alice', 'q=coffee&start_date=2024-02-01') == ['Corner Shop']
+    assert search('alice', 'q=coffee&limit=1') == ['Blue Bottle Coffee']
+    assert search('alice', 'q=coffee&limit=1&offset=1') == ['Corner Shop']
+
+def test_rejects_empty_queries(client, login):
+    _, headers = login(client, 'alice')
+    assert client.get('/receipts/search?q=%20*', headers=headers).status_code == 400
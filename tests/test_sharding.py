@@ -0,0 +1,260 @@
+import threading
+
+import pytest
+import sqlalchemy as db
+
+import app as app_module
+
+def count_receipts(shard_index: int, user_id: int) -> int:
+    with app_module.router.shards[shard_index].engine.connect() as conn:
+        return conn.execute(
+            db.select(db.func.count()).select_from(app_module.Receipt.__table__).where(
+                app_module.Receipt.user_id == user_id
+            )
+        ).scalar()
+
+def directory_entry(user_id: int):
+    with app_module.engine.connect() as conn:
+        return conn.execute(
+            db.select(app_module.UserShard.shard, app_module.UserShard.stale_shard).where(
+                app_module.UserShard.user_id == user_id
+            )
+        ).one()
+
+@pytest.fixture
+def sharded_user(configure, login, receipt):
+    """A user with three receipts on a three-shard setup: (client, user_id, headers)."""
+    configure(shards=2)
+    client = app_module.app.test_client()
+    user_id, headers = login(client, 'alice')
+    for day in ('2024-01-01', '2024-01-02', '2024-01-03'):
+        assert client.post('/receipts', json=receipt(day=day), headers=headers).status_code == 201
+    return client, user_id, headers
+
+def listed_dates(client, headers):
+    receipts = client.get('/receipts', headers=headers).get_json()['receipts']
+    return sorted(receipt['date'][:10] for receipt in receipts)
+
+def test_receipts_are_stored_on_the_users_home_shard(configure, login, receipt):
+    configure(shards=2)
+    client = app_module.app.test_client()
+    users = [login(client, f'user{n}') for n in range(8)]
+    for user_id, headers in users:
+        assert client.post('/receipts', json=receipt(), headers=headers).status_code == 201
+
+    for user_id, headers in users:
+        home = app_module.router.home_shard(user_id)
+        assert directory_entry(user_id) == (home, None)
+        assert [count_receipts(index, user_id) for index in range(3)] == [int(index == home) for index in range(3)]
+        assert len(client.get('/receipts', headers=headers).get_json()['receipts']) == 1
+
+def test_extra_shards_hold_only_receipt_tables(configure):
+    configure(shards=2)
+    receipt_tables = {table.name for table in app_module.SHARD_TABLES}
+    for shard in app_module.router.shards[1:]:
+        tables = set(db.inspect(shard.engine).get_table_names())
+        assert receipt_tables <= tables
+        assert not {'users', 'user_shards'} & tables
+    assert {'users', 'user_shards'} <= set(db.inspect(app_module.engine).get_table_names())
+
+def test_rejects_main_database_as_extra_shard(tmp_path, configure):
+    with pytest.raises(ValueError):
+        app_module.configure_database(f"sqlite:///{tmp_path / 'main.db'}", [f"sqlite:///{tmp_path / 'main.db'}"])
+
+def test_move_user(sharded_user):
+    client, user_id, headers = sharded_user
+    source = app_module.router.shard_for(user_id).index
+    target = (source + 1) % 3
+
+    assert app_module.move_user(user_id, target, 2) == 3
+    assert directory_entry(user_id) == (target, None)
+    assert count_receipts(source, user_id) == 0
+    assert count_receipts(target, user_id) == 3
+    assert listed_dates(client, headers) == ['2024-01-01', '2024-01-02', '2024-01-03']
+    expenses = client.get('/expenses?start_date=2024-01-01&end_date=2024-01-31', headers=headers).get_json()
+    assert expenses == {'Groceries': 7.5}
+
+def test_move_interrupted_before_repoint_can_be_rerun(sharded_user, monkeypatch):
+    client, user_id, headers = sharded_user
+    source = app_module.router.shard_for(user_id).index
+    target = (source + 1) % 3
+
+    insert_receipts = app_module.insert_receipts
+    calls = []
+
+    def failing_insert(session, owner, records):
+        calls.append(owner)
+        if len(calls) > 1:
+            raise RuntimeError('interrupted')
+        return insert_receipts(session, owner, records)
+
+    with monkeypatch.context() as patch, pytest.raises(RuntimeError):
+        patch.setattr(app_module, 'insert_receipts', failing_insert)
+        app_module.move_user(user_id, target, 1)
+    app_module.router.remove_sessions()
+
+    # Still served from the source; the partial copy is marked stale
+    assert directory_entry(user_id) == (source, target)
+    assert count_receipts(target, user_id) == 1
+    assert listed_dates(client, headers) == ['2024-01-01', '2024-01-02', '2024-01-03']
+
+    assert app_module.move_user(user_id, target, 1) == 3
+    assert directory_entry(user_id) == (target, None)
+    assert count_receipts(source, user_id) == 0
+    assert count_receipts(target, user_id) == 3
+
+def test_move_interrupted_before_repoint_can_be_undone(sharded_user, monkeypatch):
+    client, user_id, headers = sharded_user
+    source = app_module.router.shard_for(user_id).index
+    target = (source + 1) % 3
+
+    def failing_insert(session, owner, records):
+        raise RuntimeError('interrupted')
+
+    with monkeypatch.context() as patch, pytest.raises(RuntimeError):
+        patch.setattr(app_module, 'insert_receipts', failing_insert)
+        app_module.move_user(user_id, target, 1)
+    app_module.router.remove_sessions()
+
+    assert app_module.move_user(user_id, source, 1) == 0
+    assert directory_entry(user_id) == (source, None)
+    assert count_receipts(source, user_id) == 3
+    assert count_receipts(target, user_id) == 0
+
+def test_move_interrupted_after_repoint_finishes_on_rerun(sharded_user, monkeypatch):
+    client, user_id, headers = sharded_user
+    source = app_module.router.shard_for(user_id).index
+    target = (source + 1) % 3
+
+    delete_user_receipts = app_module.delete_user_receipts
+
+    def failing_delete(session, owner):
+        if session.info['shard'].index == source:
+            raise RuntimeError('interrupted')
+        delete_user_receipts(session, owner)
+
+    with monkeypatch.context() as patch, pytest.raises(RuntimeError):
+        patch.setattr(app_module, 'delete_user_receipts', failing_delete)
+        app_module.move_user(user_id, target, 2)
+    app_module.router.remove_sessions()
+
+    # Already served from the target; the originals are marked stale
+    assert directory_entry(user_id) == (target, source)
+    assert count_receipts(source, user_id) == 3
+    assert listed_dates(client, headers) == ['2024-01-01', '2024-01-02', '2024-01-03']
+
+    assert app_module.move_user(user_id, target, 2) == 0
+    assert directory_entry(user_id) == (target, None)
+    assert count_receipts(source, user_id) == 0
+    assert count_receipts(target, user_id) == 3
+
+def in_thread(target):
+    """Run target on another thread, as another worker would, and return its result."""
+    results = []
+    thread = threading.Thread(target=lambda: results.append(target()))
+    thread.start()
+    thread.join()
+    return results[0]
+
+def test_uploads_and_stale_reads_during_a_move(sharded_user, receipt, monkeypatch):
+    client, user_id, headers = sharded_user
+    source = app_module.router.shard_for(user_id).index
+    target = (source + 1) % 3
+
+    def upload(day):
+        return client.post('/receipts', json=receipt(day=day), headers=headers).status_code
+
+    insert_receipts = app_module.insert_receipts
+    copying = []
+
+    def insert_during_copy(session, owner, records):
+        if session.info['shard'].index == target and not copying:
+            copying.append(True)
+            # Lands on the source, which is still the user's shard
+            assert in_thread(lambda: upload('2024-01-04')) == 201
+        return insert_receipts(session, owner, records)
+
+    finish_move = app_module.finish_move
+
+    def finish_after_stale_traffic(owner, chunk_size):
+        if directory_entry(owner)[1] is None:
+            # start_move() checking for an earlier unfinished move
+            return finish_move(owner, chunk_size)
+        assert directory_entry(owner) == (target, source)
+        # Another worker still routes reads to the source from its cache
+        app_module.router._directory[owner] = (source, float('inf'))
+        assert listed_dates(client, headers) == ['2024-01-01', '2024-01-02', '2024-01-03', '2024-01-04']
+        # Writes read the directory, so this one reaches the target anyway
+        assert upload('2024-01-05') == 201
+        assert count_receipts(source, owner) == 4
+        # A write that looked up the old placement just before the repoint
+        source_shard = app_module.router.shards[source]
+
+        def late_write():
+            session = source_shard.session()
+            insert_receipts(session, owner, [app_module.receipt_validator.validate(receipt(day='2024-01-06'))[0]])
+            session.commit()
+            source_shard.session.remove()
+
+        in_thread(late_write)
+        app_module.router.forget(owner)
+        return finish_move(owner, chunk_size)
+
+    monkeypatch.setattr(app_module, 'insert_receipts', insert_during_copy)
+    monkeypatch.setattr(app_module, 'finish_move', finish_after_stale_traffic)
+    assert app_module.move_user(user_id, target, 1) == 5
+
+    assert directory_entry(user_id) == (target, None)
+    assert count_receipts(source, user_id) == 0
+    assert count_receipts(target, user_id) == 6
+    assert listed_dates(client, headers) == [f'2024-01-0{day}' for day in range(1, 7)]
+
+def test_cached_placement_expires_from_lookup_start(sharded_user, monkeypatch):
+    _, user_id, _ = sharded_user
+    router = app_module.router
+    source = router.shard_for(user_id, fresh=True).index
+    clock = iter([100.0, 200.0])
+    monkeypatch.setattr(app_module.time, 'monotonic', lambda: next(clock))
+    router.forget(user_id)
+    router.shard_for(user_id)
+    assert router._directory[user_id] == (source, 100.0 + router.directory_ttl)
+
+def test_rebalance_waits_out_the_cache_once(configure, login, receipt, monkeypatch):
+    configure(shards=2)
+    client = app_module.app.test_client()
+    users = [login(client, f'user{n}') for n in range(4)]
+    for _, headers in users:
+        client.post('/receipts', json=receipt(), headers=headers)
+
+    sleeps = []
+    monkeypatch.setattr(app_module.time, 'sleep', sleeps.append)
+    moves = [(user_id, (app_module.router.home_shard(user_id) + 1) % 3) for user_id, _ in users]
+    assert app_module.move_users(moves, 10) == [1] * len(users)
+    assert sleeps == [app_module.router.directory_ttl]
+    for user_id, target in moves:
+        assert directory_entry(user_id) == (target, None)
+
+def test_adds_move_columns_to_existing_directory(configure):
+    configure()
+    app_module.router.dispose()
+    with app_module.engine.begin() as conn:
+        conn.execute(db.text('ALTER TABLE user_shards DROP COLUMN stale_shard'))
+        conn.execute(db.text('ALTER TABLE user_shards DROP COLUMN copied_through'))
+
+    configure()
+    columns = {column['name'] for column in db.inspect(app_module.engine).get_columns('user_shards')}
+    assert {'stale_shard', 'copied_through'} <= columns
+
+def test_existing_receipts_stay_visible_when_shards_are_added(baseline_database, configure, login):
+    configure(shards=2, database=baseline_database)
+
+    client = app_module.app.test_client()
+    _, headers = login(client, 'alice', register=False)
+    assert app_module.router.shard_for(1).index == 0
+    assert len(client.get('/receipts', headers=headers).get_json()['receipts']) == 2
+
+    home = app_module.router.home_shard(1)
+    assert app_module.move_user(1, home, 1) == (2 if home else 0)
+    assert app_module.router.shard_for(1).index == home
+    receipts = client.get('/receipts', headers=headers).get_json()['receipts']
+    assert sorted(receipt['merchant'] for receipt in receipts) == ['Bakery', 'Corner Shop']
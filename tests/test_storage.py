@@ -0,0 +1,34 @@
+import sqlalchemy as db
+
+import app as app_module
+
+def test_sqlite_connections_are_tuned(client):
+    with app_module.engine.connect() as conn:
+        assert conn.exec_driver_sql('PRAGMA journal_mode').scalar() == 'wal'
+        assert conn.exec_driver_sql('PRAGMA synchronous').scalar() == 1  # NORMAL
+        assert conn.exec_driver_sql('PRAGMA cache_size').scalar() == app_module.app.config['SQLITE_PRAGMAS']['cache_size']
+
+def test_sqlite_checkouts_skip_the_ping(client):
+    statements = []
+
+    def trace(dbapi_connection, connection_record):
+        dbapi_connection.set_trace_callback(statements.append)
+
+    app_module.engine.dispose()
+    db.event.listen(app_module.engine, 'connect', trace)
+    try:
+        for _ in range(3):
+            with app_module.engine.connect():
+                pass
+    finally:
+        db.event.remove(app_module.engine, 'connect', trace)
+    assert 'SELECT 1' not in statements
+
+def test_sessions_are_removed_after_each_request(client, login, receipt):
+    _, headers = login(client, 'alice')
+    client.post('/receipts', json=receipt(), headers=headers)
+    client.get('/expenses?start_date=2024-01-01&end_date=2024-12-31', headers=headers)
+
+    assert not app_module.db_session.registry.has()
+    assert not any(shard.session.registry.has() for shard in app_module.router.shards)
+    assert app_module.engine.pool.checkedout() == 0
@@ -0,0 +1,87 @@
+from datetime import date
+
+import pytest
+
+import app as app_module
+
+def validate(data):
+    return app_module.ReceiptValidator().validate(data)
+
+def test_normalizes_a_valid_receipt():
+    receipt, errors = validate({
+        'merchant': '  corner shop ',
+        'date': '2024-01-15',
+        'total': 3,
+        'category': ' groceries',
+        'items': [{'name': ' Milk ', 'quantity': ' 2 ', 'price': 1.5}, {'name': 'Bag', 'price': 0.1}],
+    })
+    assert errors == {}
+    assert receipt == {
+        'merchant': 'Corner Shop',
+        'date': date(2024, 1, 15),
+        'category': 'Groceries',
+        'total': 3,
+        'items': [{'name': 'Milk', 'quantity': '2', 'price': 1.5}, {'name': 'Bag', 'quantity': None, 'price': 0.1}],
+    }
+
+def test_defaults_category_and_items():
+    receipt, errors = validate({'merchant': 'Shop', 'date': '2024-01-15', 'total': 1.0})
+    assert errors == {}
+    assert receipt['category'] == app_module.DEFAULT_CATEGORY
+    assert receipt['items'] == []
+
+def test_reports_every_field_error():
+    receipt, errors = validate({
+        'merchant': '',
+        'date': '2024/01/15',
+        'total': True,
+        'category': 7,
+        'items': ['milk', {'name': '', 'quantity': 2, 'price': '1.50'}],
+    })
+    assert receipt is None
+    assert errors == {
+        'merchant': 'Invalid merchant name',
+        'date': 'Invalid date format',
+        'total': 'Invalid total amount',
+        'category': 'Invalid category',
+        'items[0]': 'Expected a JSON object',
+        'items[1].name': 'Invalid item name',
+        'items[1].quantity': 'Invalid item quantity',
+        'items[1].price': 'Invalid item price',
+    }
+
+@pytest.mark.parametrize('data, error', [
+    (None, {'receipt': 'Expected a JSON object'}),
+    ({'merchant': 'Shop', 'date': '2024-01-15', 'total': 1, 'items': {}}, {'items': 'Invalid items'}),
+])
+def test_rejects_wrong_shapes(data, error):
+    assert validate(data) == (None, error)
+
+@pytest.mark.parametrize('value', ['2024-02-30', '2024-W01-1', '2024-001', '20240115', '15-01-2024', '2024-01-15T10:00'])
+def test_rejects_non_calendar_dates(value):
+    with pytest.raises(ValueError):
+        app_module.parse_date(value)
+
+def test_accepts_the_formats_strptime_accepted():
+    assert app_module.parse_date('2024-01-15') == date(2024, 1, 15)
+    assert app_module.parse_date('2024-1-5') == date(2024, 1, 5)
+
+def test_validate_many_splits_valid_and_invalid():
+    good = {'merchant': 'Shop', 'date': '2024-01-15', 'total': 1}
+    valid, invalid = app_module.ReceiptValidator().validate([good, {'merchant': 'Shop'}, good])
+    assert [index for index, _ in valid] == [0, 2]
+    assert [record['index'] for record in invalid] == [1]
+    assert set(invalid[0]['errors']) == {'date', 'total'}
+
+def test_memo_caches_are_bounded():
+    validator = app_module.ReceiptValidator(name_cache_size=3)
+    for day in range(1, 10):
+        validator.validate({'merchant': f'Shop {day}', 'date': f'2024-01-{day:02}', 'total': 1})
+    assert len(validator._merchant_names) <= 3
+    assert len(validator._dates) <= 3
+
+def test_upload_returns_field_errors(client, login):
+    _, headers = login(client, 'alice')
+    response = client.post('/receipts', json={'merchant': 'Shop', 'date': '2024-W01-1', 'total': 1}, headers=headers)
+    assert response.status_code == 400
+    assert response.get_json() == {'error': 'Invalid receipt data', 'errors': {'date': 'Invalid date format'}}